@@ -10,10 +10,16 @@ RAG система для поиска релевантных правил из
 - Hybrid filtering (strict 0.50 + adaptive 85%)
 """
 
+import json
+import re
 import sqlite3
+import threading
 import pickle
 import requests
 import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Tuple
 import logging
@@ -23,6 +29,7 @@ logger = logging.getLogger(__name__)
 # Configuration
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 DB_PATH = PROJECT_ROOT / "rag" / "db.sqlite3"
+EMBED_DIM_PATH = PROJECT_ROOT / "rag" / "ollama_dim.json"
 OLLAMA_API_URL = "http://127.0.0.1:11434/api/embeddings"
 OLLAMA_MODEL = "nomic-embed-text"
 
@@ -32,6 +39,42 @@ MIN_SIMILARITY = 0.3
 MIN_SIMILARITY_STRICT = 0.50
 ADAPTIVE_THRESHOLD_PERCENTILE = 0.85
 
+# Паттерн изменений в diff -> темы правил, которые нужно найти
+_PATTERN_TO_TAGS = {
+    'function': {'naming'},
+    'class': {'naming'},
+    'docstring': {'documentation'},
+    'error_handling': {'error handling'},
+    'import': {'imports'},
+    'type_hint': {'type hints'},
+}
+
+# HTTP сессия для Ollama: keep-alive соединения и повтор при рестарте сервера
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
+# PRAGMA для чтения индекса: большой page cache и mmap вместо read()
+READ_PRAGMAS = """
+    PRAGMA query_only = ON;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 268435456;
+"""
+
+# Первый байт pickle (opcode PROTO) - признак строк в старом формате
+PICKLE_MAGIC = b'\x80'
+
+# Кэш загруженного индекса: (DB_PATH, mtime) -> параллельные массивы
+_INDEX_CACHE: Dict[Tuple[str, int], Dict] = {}
+_INDEX_LOCK = threading.Lock()
+
+# Размерность embeddings модели Ollama (определяется один раз за процесс)
+_EMBED_DIM = None
+
 
 def generate_query_embedding(query: str) -> List[float]:
     """
@@ -47,7 +90,7 @@ def generate_query_embedding(query: str) -> List[float]:
         ConnectionError: Если Ollama недоступна
     """
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_API_URL,
             json={
                 'model': OLLAMA_MODEL,
@@ -63,28 +106,219 @@ def generate_query_embedding(query: str) -> List[float]:
         raise ConnectionError(f"Failed to generate embedding: {e}")
 
 
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+def get_embedding_dim() -> int:
+    """
+    Получить размерность embeddings модели Ollama.
+
+    Размерность сохраняется в EMBED_DIM_PATH по имени модели, поэтому
+    пробный запрос к Ollama выполняется только при первом запуске
+    (или после смены модели).
+
+    Returns:
+        Размерность вектора embedding
+
+    Raises:
+        ConnectionError: Если размерность неизвестна и Ollama недоступна
+    """
+    global _EMBED_DIM
+
+    if _EMBED_DIM is not None:
+        return _EMBED_DIM
+
+    known = {}
+    try:
+        with open(EMBED_DIM_PATH, 'r', encoding='utf-8') as f:
+            known = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    if OLLAMA_MODEL not in known:
+        known[OLLAMA_MODEL] = len(generate_query_embedding("__probe__"))
+        try:
+            with open(EMBED_DIM_PATH, 'w', encoding='utf-8') as f:
+                json.dump(known, f)
+        except OSError as e:
+            logger.warning(f"Failed to save embedding dimension: {e}")
+
+    _EMBED_DIM = int(known[OLLAMA_MODEL])
+    logger.info(f"Embedding dimension for {OLLAMA_MODEL}: {_EMBED_DIM}")
+
+    return _EMBED_DIM
+
+
+def decode_embedding(embedding_blob: bytes) -> np.ndarray:
+    """
+    Декодировать embedding из BLOB.
+
+    Формат хранения - dim x float32 (little-endian), читается без копирования.
+    Строки, проиндексированные до перехода на float32 (pickle списка float),
+    распознаются по заголовку pickle и читаются как раньше.
+
+    Args:
+        embedding_blob: BLOB из колонки embedding
+
+    Returns:
+        Вектор float32 формы (D,)
+    """
+    if embedding_blob[:1] == PICKLE_MAGIC and embedding_blob[-1:] == b'.':
+        try:
+            return np.asarray(pickle.loads(embedding_blob), dtype=np.float32)
+        except Exception:
+            pass
+
+    return np.frombuffer(embedding_blob, dtype=np.float32)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    L2-нормализовать строки матрицы (или одиночный вектор).
+
+    После нормализации косинусное сходство сводится к скалярному
+    произведению. Нулевые векторы остаются нулевыми.
+
+    Args:
+        matrix: Матрица формы (N, D) или вектор формы (D,)
+
+    Returns:
+        Нормализованный массив float32 той же формы
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms != 0)
+
+
+def top_k_indices(scores: np.ndarray, candidates: np.ndarray, top_k: int) -> np.ndarray:
     """
-    Вычислить косинусное сходство между векторами.
+    Выбрать top-K индексов кандидатов по убыванию score.
+
+    Использует argpartition (O(N)) и сортирует только K выживших.
 
     Args:
-        vec1: Первый вектор
-        vec2: Второй вектор
+        scores: Массив scores для всех правил
+        candidates: Индексы правил, прошедших порог
+        top_k: Количество результатов
+
+    Returns:
+        Индексы, отсортированные по убыванию score
+    """
+    if top_k <= 0 or candidates.size == 0:
+        return candidates[:0]
+
+    if candidates.size > top_k:
+        part = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+        candidates = candidates[part]
+
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def connect_readonly() -> sqlite3.Connection:
+    """
+    Открыть БД embeddings только для чтения с PRAGMA для быстрого чтения.
+
+    Read-only соединение не берет RESERVED-блокировку и не создает
+    файл БД, если его нет.
 
     Returns:
-        Косинусное сходство (от -1 до 1)
+        Соединение с БД
+    """
+    conn = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True)
+    conn.executescript(READ_PRAGMAS)
+    return conn
+
+
+def load_code_style_index() -> Dict:
     """
-    v1 = np.array(vec1)
-    v2 = np.array(vec2)
+    Загрузить правила CODE_STYLE из БД в виде параллельных массивов.
+
+    Embeddings нормализуются один раз при загрузке. Результат кэшируется
+    до изменения файла БД.
+
+    Raises:
+        ValueError: Если размерность embeddings в БД не совпадает с моделью
+
+    Returns:
+        Dict:
+            - ids, headings, levels, line_ranges, chunk_texts: списки метаданных
+            - embeddings: L2-нормализованная матрица float32 формы (N, D)
+    """
+    try:
+        cache_key = (str(DB_PATH), Path(DB_PATH).stat().st_mtime_ns)
+    except FileNotFoundError:
+        cache_key = None
+
+    # Параллельные запросы по файлам PR не должны загружать индекс повторно
+    with _INDEX_LOCK:
+        if cache_key is not None and cache_key in _INDEX_CACHE:
+            index = _INDEX_CACHE[cache_key]
+        else:
+            index = _read_code_style_index()
+            _INDEX_CACHE.clear()
+            _INDEX_CACHE[cache_key] = index
+
+    # Размерность проверяется по матрице целиком, а не для каждой строки;
+    # индекс с другой размерностью остается в кэше до переиндексации
+    db_dim = index['embeddings'].shape[1]
+    if index['ids'] and db_dim != get_embedding_dim():
+        raise ValueError(
+            f"Embedding dimension mismatch: code_style has {db_dim}, "
+            f"{OLLAMA_MODEL} produces {get_embedding_dim()}. "
+            f"Re-run rag/index_code_style.py"
+        )
+
+    return index
 
-    dot_product = np.dot(v1, v2)
-    norm1 = np.linalg.norm(v1)
-    norm2 = np.linalg.norm(v2)
 
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+def _read_code_style_index() -> Dict:
+    """Прочитать таблицу code_style в параллельные массивы (без кэша)."""
+    index = {
+        'ids': [],
+        'headings': [],
+        'levels': [],
+        'line_ranges': [],
+        'chunk_texts': [],
+    }
+    matrix = None
+    count = 0
+
+    conn = connect_readonly()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM code_style")
+        total = cursor.fetchone()[0]
+
+        # Строки читаются по одной прямо в заранее выделенную матрицу,
+        # нормализация - один векторизованный проход после чтения
+        cursor.execute("""
+            SELECT id, heading, level, line_range, chunk_text, embedding
+            FROM code_style
+        """)
+
+        for rule_id, heading, level, line_range, chunk_text, embedding_blob in cursor:
+            try:
+                vector = decode_embedding(embedding_blob)
+                if matrix is None:
+                    matrix = np.empty((total, vector.shape[0]), dtype=np.float32)
+                matrix[count] = vector
+            except Exception as e:
+                logger.warning(f"Failed to process rule {rule_id}: {e}")
+                continue
+
+            index['ids'].append(rule_id)
+            index['headings'].append(heading)
+            index['levels'].append(level)
+            index['line_ranges'].append(line_range)
+            index['chunk_texts'].append(chunk_text)
+            count += 1
+    finally:
+        conn.close()
+
+    index['embeddings'] = (
+        normalize_rows(matrix[:count]) if matrix is not None
+        else np.empty((0, 0), dtype=np.float32)
+    )
 
-    return float(dot_product / (norm1 * norm2))
+    return index
 
 
 def search_code_style_rules(
@@ -109,6 +343,7 @@ def search_code_style_rules(
 
     Raises:
         ConnectionError: Если Ollama недоступна
+        ValueError: Если размерность embeddings в БД не совпадает с моделью
     """
     logger.info(f"Searching CODE_STYLE rules for: '{query[:100]}...'")
 
@@ -119,59 +354,40 @@ def search_code_style_rules(
         logger.error(f"Failed to generate query embedding: {e}")
         raise
 
-    # 2. Загрузить все embeddings из БД
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # 2. Загрузить все embeddings из БД (параллельные массивы)
+    index = load_code_style_index()
 
-    cursor.execute("""
-        SELECT id, heading, level, line_range, chunk_text, embedding
-        FROM code_style
-    """)
-
-    rows = cursor.fetchall()
-    conn.close()
-
-    if not rows:
+    if not index['ids']:
         logger.warning("No code_style embeddings found in database")
         return [], {"total": 0, "filtered": 0, "mode": "none"}
 
-    logger.info(f"Loaded {len(rows)} embeddings from database")
-
-    # 3. Вычислить косинусное сходство для каждого правила
-    similarities = []
+    logger.info(f"Loaded {len(index['ids'])} embeddings from database")
 
-    for row in rows:
-        rule_id, heading, level, line_range, chunk_text, embedding_blob = row
+    # 3. Косинусное сходство = скалярное произведение нормализованных векторов
+    sims = index['embeddings'] @ normalize_rows(query_embedding)
+    candidates = np.flatnonzero(sims >= min_similarity)
 
-        try:
-            chunk_embedding = pickle.loads(embedding_blob)
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-
-            if similarity >= min_similarity:
-                similarities.append({
-                    'id': rule_id,
-                    'heading': heading,
-                    'level': level,
-                    'line_range': line_range,
-                    'chunk_text': chunk_text,
-                    'similarity': similarity
-                })
-        except Exception as e:
-            logger.warning(f"Failed to process rule {rule_id}: {e}")
-            continue
-
-    # 4. Сортировать по убыванию релевантности
-    similarities.sort(key=lambda x: x['similarity'], reverse=True)
-
-    initial_count = len(similarities)
+    initial_count = int(candidates.size)
     logger.info(f"Found {initial_count} rules above similarity {min_similarity}")
 
-    # 5. Применить hybrid filtering
-    if enable_filtering and similarities:
-        similarities = apply_hybrid_filtering(similarities, top_k)
-
-    # 6. Вернуть топ-K результатов
-    top_results = similarities[:top_k]
+    # 4. Применить hybrid filtering по сырым scores
+    if enable_filtering and candidates.size:
+        candidates = candidates[apply_hybrid_filtering(sims[candidates], top_k)]
+
+    filtered_count = int(candidates.size) if enable_filtering else initial_count
+
+    # 5. Частичная сортировка: dict создаются только для top-K правил
+    top_results = [
+        {
+            'id': index['ids'][i],
+            'heading': index['headings'][i],
+            'level': index['levels'][i],
+            'line_range': index['line_ranges'][i],
+            'chunk_text': index['chunk_texts'][i],
+            'similarity': float(sims[i])
+        }
+        for i in top_k_indices(sims, candidates, top_k)
+    ]
 
     logger.info(f"Returning {len(top_results)} rules after filtering")
 
@@ -183,7 +399,7 @@ def search_code_style_rules(
 
     stats = {
         "total": initial_count,
-        "filtered": len(similarities),
+        "filtered": filtered_count,
         "returned": len(top_results),
         "mode": "hybrid" if enable_filtering else "simple"
     }
@@ -191,7 +407,7 @@ def search_code_style_rules(
     return top_results, stats
 
 
-def apply_hybrid_filtering(similarities: List[Dict], top_k: int) -> List[Dict]:
+def apply_hybrid_filtering(sims: np.ndarray, top_k: int) -> np.ndarray:
     """
     Применить гибридную фильтрацию (strict + adaptive).
 
@@ -200,42 +416,37 @@ def apply_hybrid_filtering(similarities: List[Dict], top_k: int) -> List[Dict]:
     2. Adaptive threshold: 85% от top score (сохранить связанные правила)
 
     Args:
-        similarities: Список результатов с similarity scores
+        sims: Массив similarity scores кандидатов
         top_k: Целевое количество результатов
 
     Returns:
-        Отфильтрованный список
+        Индексы прошедших фильтрацию элементов sims
     """
-    if not similarities:
-        return []
+    if not sims.size:
+        return np.empty(0, dtype=np.intp)
 
     # Этап 1: Strict filtering
-    strict_filtered = [
-        s for s in similarities
-        if s['similarity'] >= MIN_SIMILARITY_STRICT
-    ]
+    strict_mask = sims >= MIN_SIMILARITY_STRICT
+    strict_count = int(np.count_nonzero(strict_mask))
 
-    if not strict_filtered:
+    if not strict_count:
         logger.warning(f"No results above strict threshold {MIN_SIMILARITY_STRICT}")
         # Fallback: вернуть хотя бы top результаты
-        return similarities[:top_k]
+        return top_k_indices(sims, np.arange(sims.size), top_k)
 
     # Этап 2: Adaptive filtering
-    top_score = strict_filtered[0]['similarity']
+    top_score = np.max(sims)
     adaptive_threshold = top_score * ADAPTIVE_THRESHOLD_PERCENTILE
 
-    adaptive_filtered = [
-        s for s in strict_filtered
-        if s['similarity'] >= adaptive_threshold
-    ]
+    survivors = np.flatnonzero(strict_mask & (sims >= adaptive_threshold))
 
     logger.info(
-        f"Hybrid filtering: {len(similarities)} → "
-        f"{len(strict_filtered)} (strict) → "
-        f"{len(adaptive_filtered)} (adaptive)"
+        f"Hybrid filtering: {sims.size} → "
+        f"{strict_count} (strict) → "
+        f"{survivors.size} (adaptive)"
     )
 
-    return adaptive_filtered
+    return survivors
 
 
 def build_style_query_from_diff(diff_content: str, file_path: str = "") -> str:
@@ -263,24 +474,19 @@ def build_style_query_from_diff(diff_content: str, file_path: str = "") -> str:
         'logging': r'logger\.|logging\.',
     }
 
-    detected_patterns = []
-    for pattern_name, pattern_regex in patterns.items():
-        import re
-        if re.search(pattern_regex, diff_content, re.MULTILINE):
-            detected_patterns.append(pattern_name)
+    detected_patterns = [
+        pattern_name
+        for pattern_name, pattern_regex in patterns.items()
+        if re.search(pattern_regex, diff_content, re.MULTILINE)
+    ]
 
     # Построить запрос на основе обнаруженных паттернов
     if detected_patterns:
+        tags = set().union(*(_PATTERN_TO_TAGS.get(p, ()) for p in detected_patterns))
         query_parts = [
             f"Python code review for {file_path if file_path else 'file'}:",
             f"Code patterns: {', '.join(detected_patterns)}",
-            "Need rules about: " + ", ".join([
-                "naming" if any(p in detected_patterns for p in ['function', 'class']) else "",
-                "documentation" if 'docstring' in detected_patterns else "",
-                "error handling" if 'error_handling' in detected_patterns else "",
-                "imports" if 'import' in detected_patterns else "",
-                "type hints" if 'type_hint' in detected_patterns else "",
-            ]).replace(", , ", ", ").strip(", ")
+            "Need rules about: " + ", ".join(sorted(tags))
         ]
         query = " ".join(query_parts)
     else:
@@ -304,21 +510,23 @@ def format_rules_for_llm(rules: List[Dict]) -> str:
     if not rules:
         return "No specific CODE_STYLE rules found for this code."
 
-    context_parts = [
+    separator = "\n" + "=" * 60
+    parts = [
         "=== РЕЛЕВАНТНЫЕ ПРАВИЛА ИЗ CODE_STYLE.md ===\n",
         f"Найдено {len(rules)} релевантных правил:\n"
     ]
 
+    # 5 строк на правило, один join в конце
     for i, rule in enumerate(rules, 1):
-        context_parts.append(
-            f"\n## Правило {i} (релевантность: {rule['similarity']:.2%})"
-        )
-        context_parts.append(f"**Раздел:** {rule['heading']}")
-        context_parts.append(f"**Строки:** {rule['line_range']}")
-        context_parts.append(f"\n{rule['chunk_text']}")
-        context_parts.append("\n" + "=" * 60)
+        parts.extend((
+            f"\n## Правило {i} (релевантность: {rule['similarity']:.2%})",
+            f"**Раздел:** {rule['heading']}",
+            f"**Строки:** {rule['line_range']}",
+            f"\n{rule['chunk_text']}",
+            separator
+        ))
 
-    return "\n".join(context_parts)
+    return "\n".join(parts)
 
 
 def get_rules_for_pr_review(
@@ -354,6 +562,9 @@ def get_rules_for_pr_review(
     except ConnectionError as e:
         logger.error(f"RAG search failed: {e}")
         return "CODE_STYLE rules unavailable (Ollama connection error)", [], {}
+    except ValueError as e:
+        logger.error(f"RAG search failed: {e}")
+        return f"CODE_STYLE rules unavailable ({e})", [], {}
 
     # 3. Форматировать контекст
     context = format_rules_for_llm(rules)
@@ -361,6 +572,65 @@ def get_rules_for_pr_review(
     return context, rules, stats
 
 
+def get_rules_for_pr_files(
+    file_diffs: List[Tuple[str, str]],
+    top_k: int = TOP_K,
+    per_file_top_k: int = 3,
+    max_workers: int = 4
+) -> Tuple[str, List[Dict], Dict]:
+    """
+    Получить релевантные правила отдельно для каждого файла PR.
+
+    Запросы к RAG выполняются параллельно в пуле потоков: каждый
+    упирается в HTTP-запрос к Ollama, во время которого GIL свободен.
+    Правила объединяются по id с максимальным similarity по файлам.
+
+    Args:
+        file_diffs: Список (path, diff_segment) для каждого файла
+        top_k: Итоговое количество правил
+        per_file_top_k: Количество правил на один файл
+        max_workers: Количество потоков
+
+    Returns:
+        Tuple[context, rules, stats]:
+            - context: Форматированный контекст для LLM
+            - rules: Объединенный список правил с метаданными
+            - stats: Суммарная статистика поиска
+    """
+    if not file_diffs:
+        return format_rules_for_llm([]), [], {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(
+            lambda item: get_rules_for_pr_review(item[1], item[0], top_k=per_file_top_k),
+            file_diffs
+        ))
+
+    file_stats = [stats for _, _, stats in results if stats]
+    if not file_stats:
+        # Причина недоступности (Ollama или размерность индекса) одна для всех файлов
+        return results[0][0], [], {}
+
+    # Дедупликация по id: оставить максимальный similarity
+    best = {}
+    for _, rules, _ in results:
+        for rule in rules:
+            if rule['id'] not in best or rule['similarity'] > best[rule['id']]['similarity']:
+                best[rule['id']] = rule
+
+    merged = sorted(best.values(), key=lambda r: r['similarity'], reverse=True)[:top_k]
+
+    stats = {
+        "files": len(file_diffs),
+        "total": sum(s.get("total", 0) for s in file_stats),
+        "filtered": sum(s.get("filtered", 0) for s in file_stats),
+        "returned": len(merged),
+        "mode": file_stats[0].get("mode", "none")
+    }
+
+    return format_rules_for_llm(merged), merged, stats
+
+
 # Тестирование
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
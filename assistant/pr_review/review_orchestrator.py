@@ -12,22 +12,24 @@ Entry point для GitHub Actions workflow.
 """
 
 import logging
+import re
 import sys
 import os
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, Iterator, Tuple
 
 # Добавить parent директории в path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from assistant.pr_review.rag_code_style import get_rules_for_pr_review
+from assistant.pr_review.rag_code_style import get_rules_for_pr_files
 from assistant.pr_review.deepseek_reviewer import DeepSeekReviewer
 from assistant.pr_review.github_api import GitHubAPIClient, format_review_for_github
 from assistant.pr_review.config import (
     validate_config,
     MAX_FILES_TO_REVIEW,
     MAX_DIFF_SIZE_CHARS,
-    SUPPORTED_FILE_EXTENSIONS
+    SUPPORTED_FILE_EXTENSIONS,
+    RAG_MAX_WORKERS
 )
 
 # Настройка логирования
@@ -37,6 +39,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# diff --git a/old/path.py b/new/path.py -> new/path.py
+DIFF_HEADER_RE = re.compile(r'diff --git a/.*? b/(.*)$')
+
 
 def review_pull_request(
     pr_number: int,
@@ -87,7 +92,10 @@ def review_pull_request(
         # 3. Получение diff через GitHub API (упрощённый подход)
         logger.info("\n=== Phase 3: Fetching PR Diff via GitHub API ===")
 
-        diff = github_client.get_pr_diff(pr_number)
+        diff = github_client.get_pr_diff(
+            pr_number,
+            head_sha=pr_details.get('head', {}).get('sha')
+        )
 
         if not diff:
             logger.error("❌ Failed to get PR diff from GitHub API")
@@ -95,22 +103,12 @@ def review_pull_request(
 
         logger.info(f"✅ Diff received: {len(diff)} chars")
 
-        # Проверка размера diff
-        truncated = False
-        if len(diff) > MAX_DIFF_SIZE_CHARS:
-            logger.warning(f"⚠️ Diff too large ({len(diff)} > {MAX_DIFF_SIZE_CHARS})")
-            diff = diff[:MAX_DIFF_SIZE_CHARS]
-            truncated = True
-
-        # 4. Фильтрация файлов (только Python)
+        # 4. Фильтрация файлов (только Python) за один проход по diff
         logger.info("\n=== Phase 4: Filtering Files ===")
-        changed_files = extract_changed_files_from_diff(diff)
-        python_files = [
-            f for f in changed_files
-            if any(f.endswith(ext) for ext in SUPPORTED_FILE_EXTENSIONS)
-        ]
+        python_segments = list(split_diff_by_file(diff, SUPPORTED_FILE_EXTENSIONS))
+        python_files = [path for path, _ in python_segments]
 
-        logger.info(f"Total files changed: {len(changed_files)}")
+        logger.info(f"Total files changed: {pr_details.get('changed_files', 0)}")
         logger.info(f"Python files: {len(python_files)}")
 
         if not python_files:
@@ -124,13 +122,25 @@ def review_pull_request(
             github_client.post_comment(pr_number, comment)
             return True
 
+        diff = "".join(segment for _, segment in python_segments)
+        logger.info(f"Python diff: {len(diff)} chars")
+
+        # Проверка размера diff
+        truncated = False
+        if len(diff) > MAX_DIFF_SIZE_CHARS:
+            logger.warning(f"⚠️ Diff too large ({len(diff)} > {MAX_DIFF_SIZE_CHARS})")
+            diff = diff[:MAX_DIFF_SIZE_CHARS]
+            truncated = True
+
         # 5. RAG поиск релевантных правил из CODE_STYLE.md
         logger.info("\n=== Phase 5: RAG Search for Style Rules ===")
         try:
-            rules_context, rules, rag_stats = get_rules_for_pr_review(
-                diff_content=diff,
-                file_path=", ".join(python_files[:3]),  # Первые 3 файла
-                top_k=5
+            # Отдельный запрос на каждый файл, запросы выполняются параллельно
+            rules_context, rules, rag_stats = get_rules_for_pr_files(
+                python_segments[:MAX_FILES_TO_REVIEW],
+                top_k=5,
+                per_file_top_k=3,
+                max_workers=RAG_MAX_WORKERS
             )
 
             logger.info(f"✅ Found {len(rules)} relevant rules")
@@ -197,33 +207,37 @@ def review_pull_request(
         return False
 
 
-def extract_changed_files_from_diff(diff: str) -> list:
+def split_diff_by_file(diff: str, extensions: Optional[list] = None) -> Iterator[Tuple[str, str]]:
     """
-    Извлечь список измененных файлов из diff.
+    Разбить diff на сегменты по файлам за один проход.
+
+    Сегмент начинается со строки "diff --git a/... b/..." и включает
+    все hunks файла до следующей такой строки.
 
     Args:
         diff: Git diff содержимое
+        extensions: Допустимые расширения файлов (None - все файлы)
 
-    Returns:
-        Список путей к файлам
+    Yields:
+        Tuple[path, segment] для файлов с подходящим расширением
     """
-    import re
-
-    files = set()
-
-    # Паттерны для поиска файлов в diff
-    # diff --git a/file.py b/file.py
-    # +++ b/file.py
-    patterns = [
-        r'diff --git a/(.*?) b/',
-        r'\+\+\+ b/(.*?)$'
-    ]
-
-    for pattern in patterns:
-        matches = re.findall(pattern, diff, re.MULTILINE)
-        files.update(matches)
-
-    return sorted(list(files))
+    path = None
+    segment = []
+
+    for line in diff.splitlines(keepends=True):
+        if line.startswith('diff --git '):
+            if segment:
+                yield path, "".join(segment)
+
+            match = DIFF_HEADER_RE.match(line)
+            path = match.group(1) if match else line[len('diff --git '):].strip()
+            keep = extensions is None or path.endswith(tuple(extensions))
+            segment = [line] if keep else []
+        elif segment:
+            segment.append(line)
+
+    if segment:
+        yield path, "".join(segment)
 
 
 def main():
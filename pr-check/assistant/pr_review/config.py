@@ -21,6 +21,7 @@ RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
 RAG_MIN_SIMILARITY = float(os.getenv("RAG_MIN_SIMILARITY", "0.3"))
 RAG_FILTERING_MODE = os.getenv("RAG_FILTERING_MODE", "hybrid")
 RAG_CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "800"))
+RAG_MAX_WORKERS = int(os.getenv("RAG_MAX_WORKERS", "4"))
 
 # Ollama
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://127.0.0.1:11434/api/embeddings")
@@ -40,6 +41,7 @@ REVIEW_MAX_TOKENS = int(os.getenv("REVIEW_MAX_TOKENS", "3000"))
 GITHUB_API_BASE = os.getenv("GITHUB_API_BASE", "https://api.github.com")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPOSITORY = os.getenv("GITHUB_REPOSITORY")  # format: owner/repo
+PR_CACHE_DIR = Path(os.getenv("PR_CACHE_DIR", "/tmp/pr_cache"))  # кэш diff PR по head SHA
 
 # PR Review Constraints
 MAX_FILES_TO_REVIEW = int(os.getenv("MAX_FILES_TO_REVIEW", "20"))
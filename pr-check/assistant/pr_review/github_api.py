@@ -7,20 +7,27 @@ GitHub API Integration для PR Review
 - Получение информации о PR
 - Публикация review комментариев
 - Поддержка review events: APPROVE, REQUEST_CHANGES, COMMENT
+- Кэширование PR details и diff по head SHA (повторные запуски)
 """
 
+import json
 import requests
 import logging
-from typing import Dict, Optional
+from pathlib import Path
+from typing import Dict, Optional, Tuple
 
 from .config import (
     GITHUB_API_BASE,
     GITHUB_TOKEN,
-    GITHUB_REPOSITORY
+    GITHUB_REPOSITORY,
+    PR_CACHE_DIR
 )
 
 logger = logging.getLogger(__name__)
 
+# In-memory кэш поверх дискового: (repository, pr_number) -> запись кэша
+_PR_CACHE: Dict[Tuple[str, int], Dict] = {}
+
 
 class GitHubAPIClient:
     """
@@ -65,6 +72,9 @@ class GitHubAPIClient:
         """
         Получить детальную информацию о PR.
 
+        Не кэшируется: title/body можно изменить без нового push (head SHA
+        тот же), а сам ответ небольшой. По SHA кэшируется только diff.
+
         Args:
             pr_number: Номер Pull Request
 
@@ -100,16 +110,23 @@ class GitHubAPIClient:
                 logger.error(f"Response: {e.response.text}")
             return None
 
-    def get_pr_diff(self, pr_number: int) -> Optional[str]:
+    def get_pr_diff(self, pr_number: int, head_sha: Optional[str] = None) -> Optional[str]:
         """
         Получить diff для PR через GitHub API.
 
         Args:
             pr_number: Номер Pull Request
+            head_sha: SHA head коммита PR; при совпадении с кэшем diff
+                берется из кэша без запроса к API
 
         Returns:
             Строка с diff или None при ошибке
         """
+        cached = self._load_cached(pr_number, head_sha)
+        if 'diff' in cached:
+            logger.info(f"PR #{pr_number} diff loaded from cache ({head_sha[:7]})")
+            return cached['diff']
+
         url = f"{self.api_base}/repos/{self.repository}/pulls/{pr_number}"
 
         # Используем специальный Accept header для получения diff
@@ -125,6 +142,8 @@ class GitHubAPIClient:
             diff = response.text
             logger.info(f"✅ Diff received: {len(diff)} chars")
 
+            self._store_cached(pr_number, head_sha, diff=diff)
+
             return diff
 
         except requests.exceptions.RequestException as e:
@@ -133,6 +152,71 @@ class GitHubAPIClient:
                 logger.error(f"Response: {e.response.text}")
             return None
 
+    def _cache_path(self, pr_number: int) -> Path:
+        """Путь к файлу кэша PR: {PR_CACHE_DIR}/{owner}/{repo}/{pr}.json"""
+        return PR_CACHE_DIR / self.repository / f"{pr_number}.json"
+
+    def _load_cached(self, pr_number: int, head_sha: Optional[str]) -> Dict:
+        """
+        Получить запись кэша для PR, если она соответствует head_sha.
+
+        Args:
+            pr_number: Номер Pull Request
+            head_sha: Ожидаемый SHA head коммита
+
+        Returns:
+            Dict с ключом diff (пустой при промахе кэша)
+        """
+        if not head_sha:
+            return {}
+
+        key = (self.repository, pr_number)
+        entry = _PR_CACHE.get(key)
+
+        if entry is None:
+            try:
+                with open(self._cache_path(pr_number), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return {}
+            _PR_CACHE[key] = entry
+
+        # Новый push в PR меняет head SHA - старый кэш недействителен
+        if entry.get('head_sha') != head_sha:
+            return {}
+
+        return entry
+
+    def _store_cached(self, pr_number: int, head_sha: Optional[str], **fields):
+        """
+        Сохранить diff PR в кэш (память + диск).
+
+        Args:
+            pr_number: Номер Pull Request
+            head_sha: SHA head коммита, к которому относятся данные
+            **fields: Сохраняемые поля (diff)
+        """
+        if not head_sha:
+            return
+
+        key = (self.repository, pr_number)
+        entry = _PR_CACHE.get(key)
+        if entry is None or entry.get('head_sha') != head_sha:
+            entry = self._load_cached(pr_number, head_sha) or {'head_sha': head_sha}
+
+        entry.update(fields)
+        _PR_CACHE[key] = entry
+
+        path = self._cache_path(pr_number)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            tmp_path.replace(path)
+        except OSError as e:
+            logger.warning(f"Failed to write PR cache {path}: {e}")
+
     def post_review(
         self,
         pr_number: int,
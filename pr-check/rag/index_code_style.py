@@ -12,9 +12,13 @@
 - Метаданные: heading, level, line_range для точных ссылок
 """
 
+import hashlib
+import os
 import sqlite3
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 import logging
 import re
@@ -29,15 +33,104 @@ DB_PATH = Path(__file__).parent / "db.sqlite3"
 
 # Ollama Configuration
 OLLAMA_API_URL = "http://127.0.0.1:11434/api/embeddings"
+OLLAMA_EMBED_URL = "http://127.0.0.1:11434/api/embed"  # batch endpoint
 OLLAMA_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))  # 128 для CUDA
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))  # параллельные запросы к Ollama
+EMBED_TIMEOUT = 60  # секунд на запрос с одним текстом
+EMBED_TIMEOUT_PER_TEXT = 5  # секунд сверх EMBED_TIMEOUT на каждый текст батча
+
+# Одна HTTP сессия на весь прогон: keep-alive вместо нового TCP соединения на запрос
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+# PRAGMA для записи индекса: WAL и меньше fsync на commit
+WRITE_PRAGMAS = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+"""
 
 # Chunking Configuration
 CHUNK_SIZE = 800  # Оптимальный размер для баланса контекста и точности
+SEMANTIC_CHUNKING = os.getenv("SEMANTIC_CHUNKING", "1") == "1"  # "0" - разбиение только по размеру
+SEMANTIC_SPLIT_PERCENTILE = 10  # Разрез там, где сходство соседних фрагментов ниже этого перцентиля
+SEMANTIC_MIN_CHUNK_SIZE = 200  # Меньшие части по провалу сходства не отрезаются
+
+# Заголовок markdown: строка, начинающаяся с '#'
+HEADING_RE = re.compile(r'^#[^\n]*', re.MULTILINE)
+
+# Code block: от строки ``` до следующей строки ``` (или до конца файла)
+FENCE_RE = re.compile(r'^[^\S\n]*```.*?(?:^[^\S\n]*```[^\n]*|\Z)', re.MULTILINE | re.DOTALL)
+
+# Слово для разбиения длинных строк
+WORD_RE = re.compile(r'\S+')
+
+# Граница фрагмента для семантического разбиения: перевод строки или конец предложения
+SEGMENT_BOUNDARY_RE = re.compile(r'\n+|(?<=[.!?])[^\S\n]+')
+
+
+def generate_embeddings_batch(texts: list) -> list:
+    """
+    Генерировать embeddings для нескольких текстов одним запросом к Ollama.
+
+    Использует batch endpoint /api/embed. Если он недоступен (старая
+    версия Ollama) или ответ без "embeddings", выполняет по одному
+    запросу на текст через /api/embeddings.
+
+    Args:
+        texts: Тексты для embedding
+
+    Returns:
+        Векторы embedding в порядке входных текстов
+    """
+    try:
+        try:
+            response = _SESSION.post(
+                OLLAMA_EMBED_URL,
+                json={
+                    'model': OLLAMA_MODEL,
+                    'input': texts
+                },
+                timeout=EMBED_TIMEOUT + EMBED_TIMEOUT_PER_TEXT * len(texts)
+            )
+        except requests.RequestException as e:
+            if len(texts) == 1:
+                raise
+            # Батч не уложился (таймаут, обрыв) - повторить по одному тексту,
+            # чтобы не потерять весь батч
+            logger.warning(f"Batch of {len(texts)} texts failed ({e}), retrying one by one")
+            return [generate_embedding_single(text) for text in texts]
+
+        if response.status_code != 404:
+            response.raise_for_status()
+            result = response.json()
+            if 'embeddings' in result:
+                return result['embeddings']
+
+        logger.warning("Ollama /api/embed unavailable, falling back to /api/embeddings")
+        return [generate_embedding_single(text) for text in texts]
+    except Exception as e:
+        logger.error(f"Error generating embeddings batch: {e}")
+        raise
 
 
 def generate_embedding(text: str) -> list:
     """
-    Генерировать embedding через Ollama.
+    Генерировать embedding для одного текста.
+
+    Args:
+        text: Текст для embedding
+
+    Returns:
+        Вектор embedding
+    """
+    return generate_embeddings_batch([text])[0]
+
+
+def generate_embedding_single(text: str) -> list:
+    """
+    Генерировать embedding через legacy endpoint /api/embeddings.
 
     Args:
         text: Текст для embedding
@@ -46,13 +139,13 @@ def generate_embedding(text: str) -> list:
         Вектор embedding
     """
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_API_URL,
             json={
                 'model': OLLAMA_MODEL,
                 'prompt': text
             },
-            timeout=60
+            timeout=EMBED_TIMEOUT
         )
         response.raise_for_status()
         result = response.json()
@@ -62,7 +155,7 @@ def generate_embedding(text: str) -> list:
         raise
 
 
-def chunk_code_style_document(content: str) -> list:
+def chunk_code_style_document(content: str, embed_fn=None) -> list:
     """
     Разбить CODE_STYLE.md на чанки с сохранением контекста.
 
@@ -70,89 +163,65 @@ def chunk_code_style_document(content: str) -> list:
     - Разбивка по заголовкам
     - Сохранение примеров кода с их объяснениями
     - Ограничение размера chunk: 800 символов
+    - Большие секции режутся по смысловым границам (если задан embed_fn)
     - Метаданные: heading, level, line_range
 
     Args:
         content: Содержимое CODE_STYLE.md
+        embed_fn: Функция texts -> embeddings для семантического разбиения
+            больших секций (None - разбиение только по размеру)
 
     Returns:
         Список чанков с метаданными
     """
-    chunks = []
-    lines = content.split('\n')
+    # Code blocks маскируются, чтобы '#' внутри них не считался заголовком
+    masked = FENCE_RE.sub(lambda m: '\x00' * len(m.group()), content)
 
-    current_chunk = []
+    chunks = []
     current_heading = "Introduction"
     current_level = 0
+    chunk_start = 0
     chunk_start_line = 1
-    line_number = 1
-
-    in_code_block = False
-    code_block_lines = []
-
-    for line in lines:
-        # Отслеживание code blocks
-        if line.strip().startswith('```'):
-            in_code_block = not in_code_block
-            if in_code_block:
-                # Начало code block
-                code_block_lines = [line]
-            else:
-                # Конец code block - добавить весь блок
-                code_block_lines.append(line)
-                current_chunk.extend(code_block_lines)
-                code_block_lines = []
-                line_number += 1
-                continue
-
-        if in_code_block:
-            code_block_lines.append(line)
-            line_number += 1
-            continue
-
-        # Обнаружение заголовка
-        if line.startswith('#') and not in_code_block:
-            # Сохранить предыдущий чанк
-            if current_chunk:
-                chunk_text = '\n'.join(current_chunk)
-                chunks.extend(
-                    process_chunk(
-                        chunk_text,
-                        current_heading,
-                        current_level,
-                        chunk_start_line,
-                        line_number - 1
-                    )
-                )
-                current_chunk = []
-                chunk_start_line = line_number
 
-            # Новый заголовок
-            level = len(line.split()[0])  # Количество #
-            heading = line.lstrip('#').strip()
-            current_heading = heading
-            current_level = level
+    for match in HEADING_RE.finditer(masked):
+        # Сохранить предыдущий чанк (текст до заголовка, без завершающего \n)
+        if match.start() > 0:
+            chunk_end_line = chunk_start_line + content.count('\n', chunk_start, match.start()) - 1
+            chunks.extend(
+                process_chunk(
+                    content[chunk_start:match.start() - 1],
+                    current_heading,
+                    current_level,
+                    chunk_start_line,
+                    chunk_end_line,
+                    embed_fn
+                )
+            )
+            chunk_start_line = chunk_end_line + 1
 
-        current_chunk.append(line)
-        line_number += 1
+        # Новый заголовок
+        line = match.group()
+        current_level = len(line.split()[0])  # Количество #
+        current_heading = line.lstrip('#').strip()
+        chunk_start = match.start()
 
     # Последний чанк
-    if current_chunk:
-        chunk_text = '\n'.join(current_chunk)
-        chunks.extend(
-            process_chunk(
-                chunk_text,
-                current_heading,
-                current_level,
-                chunk_start_line,
-                line_number - 1
-            )
+    chunks.extend(
+        process_chunk(
+            content[chunk_start:],
+            current_heading,
+            current_level,
+            chunk_start_line,
+            chunk_start_line + content.count('\n', chunk_start),
+            embed_fn
         )
+    )
 
     return chunks
 
 
-def process_chunk(text: str, heading: str, level: int, start_line: int, end_line: int) -> list:
+def process_chunk(text: str, heading: str, level: int, start_line: int, end_line: int,
+                  embed_fn=None) -> list:
     """
     Обработать чанк: разбить на части если слишком большой.
 
@@ -162,6 +231,7 @@ def process_chunk(text: str, heading: str, level: int, start_line: int, end_line
         level: Уровень заголовка
         start_line: Начальная строка
         end_line: Конечная строка
+        embed_fn: Функция texts -> embeddings для семантического разбиения
 
     Returns:
         Список обработанных чанков
@@ -175,8 +245,11 @@ def process_chunk(text: str, heading: str, level: int, start_line: int, end_line
         }]
 
     # Разбить большой чанк на части
-    # Стратегия: пытаться разбивать по параграфам, затем по предложениям
-    sub_chunks = smart_split_chunk(text, CHUNK_SIZE)
+    # Стратегия: по смысловым границам, иначе по параграфам, затем по предложениям
+    if embed_fn is not None:
+        sub_chunks = semantic_split_chunk(text, CHUNK_SIZE, embed_fn)
+    else:
+        sub_chunks = smart_split_chunk(text, CHUNK_SIZE)
 
     result = []
     for i, sub in enumerate(sub_chunks):
@@ -190,6 +263,67 @@ def process_chunk(text: str, heading: str, level: int, start_line: int, end_line
     return result
 
 
+def semantic_split_chunk(text: str, max_size: int, embed_fn) -> list:
+    """
+    Семантическое разбиение чанка: разрезы там, где меняется тема.
+
+    Текст делится на фрагменты (предложения и строки; code blocks
+    неделимы), фрагменты embed-ятся одним batch запросом. Разрез ставится
+    между соседними фрагментами, сходство которых ниже
+    SEMANTIC_SPLIT_PERCENTILE-го перцентиля (если часть уже не меньше
+    SEMANTIC_MIN_CHUNK_SIZE), или когда часть превысила бы max_size.
+    Части - срезы исходного текста.
+
+    Args:
+        text: Текст для разбиения
+        max_size: Максимальный размер части
+        embed_fn: Функция texts -> embeddings
+
+    Returns:
+        Список частей (при ошибке embedding - результат smart_split_chunk)
+    """
+    # 1. Границы фрагментов вне code blocks
+    masked = FENCE_RE.sub(lambda m: '\x00' * len(m.group()), text)
+    bounds = [0] + [m.end() for m in SEGMENT_BOUNDARY_RE.finditer(masked) if 0 < m.end() < len(text)]
+    bounds.append(len(text))
+    segments = [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+    if len(segments) < 3:
+        return smart_split_chunk(text, max_size)
+
+    # 2. Сходство соседних фрагментов (векторизовано)
+    try:
+        vectors = np.asarray(embed_fn([segment.strip() for segment in segments]), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    except Exception as e:
+        logger.warning(f"Semantic chunking failed, falling back to size-based split: {e}")
+        return smart_split_chunk(text, max_size)
+
+    similarities = np.einsum('ij,ij->i', vectors[:-1], vectors[1:])
+    is_trough = similarities < np.percentile(similarities, SEMANTIC_SPLIT_PERCENTILE)
+
+    # 3. Набор фрагментов в части до провала сходства или лимита размера
+    parts = []
+    part_start = 0
+    for i in range(1, len(segments)):
+        at_trough = is_trough[i - 1] and bounds[i] - bounds[part_start] >= SEMANTIC_MIN_CHUNK_SIZE
+        if at_trough or bounds[i + 1] - bounds[part_start] > max_size:
+            parts.append(text[bounds[part_start]:bounds[i]])
+            part_start = i
+    parts.append(text[bounds[part_start]:])
+
+    # Неделимый фрагмент больше max_size (длинный code block) режется по размеру
+    result = []
+    for part in parts:
+        part = part.strip('\n').rstrip()
+        if len(part) > max_size:
+            result.extend(smart_split_chunk(part, max_size))
+        elif part:
+            result.append(part)
+
+    return result
+
+
 def smart_split_chunk(text: str, max_size: int) -> list:
     """
     Умное разбиение чанка с сохранением контекста.
@@ -212,35 +346,42 @@ def smart_split_chunk(text: str, max_size: int) -> list:
     if all(len(p) <= max_size for p in paragraphs):
         return merge_small_chunks(paragraphs, max_size)
 
-    # Попытка 2: разбить по строкам
-    lines = text.split('\n')
+    # Попытка 2: разбить по строкам.
+    # Части - срезы text по смещениям строк, без промежуточных списков строк
     result = []
-    current = []
+    chunk_start = 0
+    chunk_end = None  # Конец последней строки текущей части (None - часть пуста)
     current_size = 0
+    line_start = 0
 
-    for line in lines:
-        line_size = len(line) + 1  # +1 для \n
+    while line_start <= len(text):
+        line_end = text.find('\n', line_start)
+        if line_end == -1:
+            line_end = len(text)
+        line_size = line_end - line_start + 1  # +1 для \n
 
         # Если строка сама по себе больше max_size, разбить по словам
         if line_size > max_size:
-            if current:
-                result.append('\n'.join(current))
-                current = []
+            if chunk_end is not None:
+                result.append(text[chunk_start:chunk_end])
+                chunk_end = None
                 current_size = 0
             # Разбить длинную строку по словам
-            result.extend(split_by_words(line, max_size))
-            continue
-
-        if current_size + line_size > max_size and current:
-            result.append('\n'.join(current))
-            current = [line]
+            result.extend(split_by_words(text[line_start:line_end], max_size))
+        elif current_size + line_size > max_size and chunk_end is not None:
+            result.append(text[chunk_start:chunk_end])
+            chunk_start, chunk_end = line_start, line_end
             current_size = line_size
         else:
-            current.append(line)
+            if chunk_end is None:
+                chunk_start = line_start
+            chunk_end = line_end
             current_size += line_size
 
-    if current:
-        result.append('\n'.join(current))
+        line_start = line_end + 1
+
+    if chunk_end is not None:
+        result.append(text[chunk_start:chunk_end])
 
     return result
 
@@ -249,6 +390,9 @@ def split_by_words(text: str, max_size: int) -> list:
     """
     Разбить текст по словам.
 
+    Части - срезы исходного текста между первым и последним словом,
+    пробелы внутри части сохраняются как в оригинале.
+
     Args:
         text: Текст для разбиения
         max_size: Максимальный размер части
@@ -256,23 +400,20 @@ def split_by_words(text: str, max_size: int) -> list:
     Returns:
         Список частей
     """
-    words = text.split()
     result = []
-    current = []
-    current_size = 0
+    chunk_start = 0
+    chunk_end = None  # Конец последнего слова текущей части (None - часть пуста)
 
-    for word in words:
-        word_size = len(word) + 1  # +1 для пробела
-        if current_size + word_size > max_size and current:
-            result.append(' '.join(current))
-            current = [word]
-            current_size = word_size
-        else:
-            current.append(word)
-            current_size += word_size
+    for word in WORD_RE.finditer(text):
+        if chunk_end is not None and word.end() - chunk_start >= max_size:
+            result.append(text[chunk_start:chunk_end])
+            chunk_end = None
+        if chunk_end is None:
+            chunk_start = word.start()
+        chunk_end = word.end()
 
-    if current:
-        result.append(' '.join(current))
+    if chunk_end is not None:
+        result.append(text[chunk_start:chunk_end])
 
     return result
 
@@ -308,9 +449,13 @@ def merge_small_chunks(chunks: list, max_size: int) -> list:
     return result
 
 
-def create_database():
-    """Создать таблицу для хранения embeddings CODE_STYLE.md."""
-    conn = sqlite3.connect(DB_PATH)
+def create_database(conn: sqlite3.Connection):
+    """
+    Создать таблицу для хранения embeddings CODE_STYLE.md.
+
+    Args:
+        conn: Соединение с БД (открывается и закрывается вызывающим кодом)
+    """
     cursor = conn.cursor()
 
     # Создать таблицу для CODE_STYLE embeddings
@@ -321,31 +466,155 @@ def create_database():
             level INTEGER,
             line_range TEXT,
             chunk_text TEXT NOT NULL,
-            embedding BLOB NOT NULL,
+            embedding BLOB NOT NULL,  -- dim x float32 (little-endian)
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
 
+    # Миграция: content_hash для инкрементальной переиндексации
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(code_style)")}
+    if 'content_hash' not in columns:
+        cursor.execute("ALTER TABLE code_style ADD COLUMN content_hash TEXT")
+
+    # Миграция: модель embedding строки (после смены OLLAMA_MODEL строки
+    # пересчитываются). До появления колонки использовалась только OLLAMA_MODEL
+    if 'model' not in columns:
+        cursor.execute("ALTER TABLE code_style ADD COLUMN model TEXT")
+        cursor.execute("UPDATE code_style SET model = ?", (OLLAMA_MODEL,))
+
     # Создать индекс для ускорения поиска
     cursor.execute("""
         CREATE INDEX IF NOT EXISTS idx_code_style_heading
         ON code_style(heading)
     """)
 
+    # Кэш embeddings по SHA-256 текста (общий для всех индексаторов)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            hash TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            embedding BLOB NOT NULL  -- dim x float32 (little-endian)
+        )
+    """)
+
     conn.commit()
-    conn.close()
     logger.info("✅ Database table 'code_style' created")
 
 
+def content_hash(text: str) -> str:
+    """SHA-256 текста чанка (ключ кэша embeddings)."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_cached_embedding(cursor: sqlite3.Cursor, text_hash: str):
+    """
+    Найти сохраненный embedding по hash текста.
+
+    Args:
+        cursor: Курсор БД
+        text_hash: SHA-256 текста (content_hash)
+
+    Returns:
+        BLOB embedding или None, если в кэше нет записи для текущей модели
+    """
+    cursor.execute(
+        "SELECT embedding FROM embedding_cache WHERE hash = ? AND model = ?",
+        (text_hash, OLLAMA_MODEL)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def store_cached_embeddings(cursor: sqlite3.Cursor, entries: list):
+    """
+    Сохранить embeddings в кэш по hash текста.
+
+    Args:
+        cursor: Курсор БД
+        entries: Список (content_hash, сериализованный embedding)
+    """
+    cursor.executemany(
+        "INSERT OR REPLACE INTO embedding_cache (hash, model, embedding) VALUES (?, ?, ?)",
+        [(text_hash, OLLAMA_MODEL, embedding_blob) for text_hash, embedding_blob in entries]
+    )
+
+
+def embed_texts_cached(cursor: sqlite3.Cursor, texts: list) -> list:
+    """
+    Получить embeddings текстов через кэш: недостающие - одним batch запросом.
+
+    Используется для фрагментов семантического chunking, чтобы повторная
+    индексация не embed-ила их заново.
+
+    Args:
+        cursor: Курсор БД
+        texts: Тексты для embedding
+
+    Returns:
+        Векторы float32 в порядке texts
+    """
+    hashes = [content_hash(text) for text in texts]
+    blobs = [get_cached_embedding(cursor, text_hash) for text_hash in hashes]
+
+    missing = [i for i, blob in enumerate(blobs) if blob is None]
+    if missing:
+        embeddings = generate_embeddings_batch([texts[i] for i in missing])
+        for i, embedding in zip(missing, embeddings):
+            blobs[i] = embedding_to_blob(embedding)
+        store_cached_embeddings(cursor, [(hashes[i], blobs[i]) for i in missing])
+
+    return [np.frombuffer(blob, dtype=np.float32) for blob in blobs]
+
+
+def embedding_to_blob(embedding) -> bytes:
+    """
+    Сериализовать embedding в BLOB: L2-нормализованный float32.
+
+    Векторы хранятся единичной длины, поэтому при поиске косинусное
+    сходство - это скалярное произведение без вычисления норм.
+
+    Args:
+        embedding: Вектор embedding (список float или массив)
+
+    Returns:
+        dim x float32 (little-endian)
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector = vector / norm
+    return vector.tobytes()
+
+
+def insert_code_style_chunks(cursor: sqlite3.Cursor, chunks: list, embedding_blobs: list):
+    """
+    Сохранить чанки CODE_STYLE с embeddings в таблицу code_style.
+
+    Args:
+        cursor: Курсор БД
+        chunks: Чанки с метаданными и content_hash
+        embedding_blobs: Сериализованные embeddings в порядке чанков
+    """
+    cursor.executemany("""
+        INSERT INTO code_style (heading, level, line_range, chunk_text, embedding, content_hash, model)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (chunk['heading'], chunk['level'], chunk['line_range'], chunk['text'], embedding_blob, chunk['hash'],
+         OLLAMA_MODEL)
+        for chunk, embedding_blob in zip(chunks, embedding_blobs)
+    ])
+
+
 def index_code_style():
     """
     Основная функция индексации CODE_STYLE.md.
 
     Процесс:
     1. Читает CODE_STYLE.md
-    2. Разбивает на оптимальные чанки
-    3. Генерирует embeddings через Ollama
-    4. Сохраняет в БД
+    2. Разбивает на оптимальные чанки (большие секции - по смысловым границам)
+    3. Сравнивает чанки с БД по content hash (неизмененные пропускаются)
+    4. Генерирует недостающие embeddings через Ollama (или берет из кэша)
+    5. Сохраняет в БД
     """
     logger.info("Starting CODE_STYLE.md indexing...")
 
@@ -358,66 +627,121 @@ def index_code_style():
     with open(CODE_STYLE_PATH, 'r', encoding='utf-8') as f:
         content = f.read()
 
-    logger.info(f"File size: {len(content)} chars, {len(content.splitlines())} lines")
-
-    # 3. Chunking
-    logger.info("Chunking document...")
-    chunks = chunk_code_style_document(content)
-    logger.info(f"Created {len(chunks)} chunks")
+    # Строки считаются так же, как их нумерует chunk_code_style_document (line_range)
+    n_chars = len(content)
+    n_lines = content.count('\n') + 1
+    logger.info(f"File size: {n_chars} chars, {n_lines} lines")
 
-    # Статистика по размерам чанков
-    sizes = [len(c['text']) for c in chunks]
-    logger.info(f"Chunk sizes: min={min(sizes)}, max={max(sizes)}, avg={sum(sizes)//len(sizes)}")
-
-    # 4. Создание БД
-    create_database()
-
-    # 5. Очистка старых данных
+    # Одно соединение на весь прогон: PRAGMA и page cache действуют до конца
     conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM code_style")
-    conn.commit()
-    logger.info("Cleared existing code_style data")
-
-    # 6. Генерация embeddings и сохранение
-    logger.info("Generating embeddings...")
-    for i, chunk in enumerate(chunks, 1):
-        logger.info(f"Processing chunk {i}/{len(chunks)}: {chunk['heading'][:50]}...")
-
-        try:
-            # Генерировать embedding
-            embedding = generate_embedding(chunk['text'])
-
-            # Сохранить в БД
-            cursor.execute("""
-                INSERT INTO code_style (heading, level, line_range, chunk_text, embedding)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                chunk['heading'],
-                chunk['level'],
-                chunk['line_range'],
-                chunk['text'],
-                pickle.dumps(embedding)
-            ))
+    conn.executescript(WRITE_PRAGMAS)
 
+    try:
+        # 3. Создание БД (кэш embeddings нужен уже для семантического chunking)
+        create_database(conn)
+        cursor = conn.cursor()
+
+        # 4. Chunking
+        logger.info(f"Chunking document (semantic: {SEMANTIC_CHUNKING})...")
+        if SEMANTIC_CHUNKING:
+            chunks = chunk_code_style_document(content, lambda texts: embed_texts_cached(cursor, texts))
             conn.commit()
-        except Exception as e:
-            logger.error(f"Failed to process chunk {i}: {e}")
-            continue
+        else:
+            chunks = chunk_code_style_document(content)
+        logger.info(f"Created {len(chunks)} chunks")
+
+        # Статистика по размерам чанков
+        sizes = [len(c['text']) for c in chunks]
+        logger.info(f"Chunk sizes: min={min(sizes)}, max={max(sizes)}, avg={sum(sizes)//len(sizes)}")
+
+        # 5. Сравнение с уже проиндексированными строками по content hash и модели:
+        # неизмененные строки не трогаются, удаляются только устаревшие
+        # (в том числе с embedding другой модели)
+        existing = {}
+        cursor.execute("SELECT id, heading, level, line_range, content_hash, model FROM code_style")
+        for row_id, heading, level, line_range, text_hash, model in cursor.fetchall():
+            existing.setdefault((heading, level, line_range, text_hash, model), []).append(row_id)
+
+        new_chunks = []
+        for chunk in chunks:
+            chunk['hash'] = content_hash(chunk['text'])
+            row_ids = existing.get(
+                (chunk['heading'], chunk['level'], chunk['line_range'], chunk['hash'], OLLAMA_MODEL)
+            )
+            if row_ids:
+                row_ids.pop()
+            else:
+                new_chunks.append(chunk)
 
-    conn.close()
+        stale_ids = [(row_id,) for row_ids in existing.values() for row_id in row_ids]
+        cursor.executemany("DELETE FROM code_style WHERE id = ?", stale_ids)
+        logger.info(
+            f"Unchanged: {len(chunks) - len(new_chunks)}, "
+            f"new: {len(new_chunks)}, removed: {len(stale_ids)}"
+        )
 
-    logger.info(f"✅ Indexing complete! {len(chunks)} chunks indexed")
-    logger.info(f"Database: {DB_PATH}")
+        # 6. Чанки с embedding в кэше сохраняются без запроса к Ollama
+        cached_chunks, cached_blobs, to_embed = [], [], []
+        for chunk in new_chunks:
+            embedding_blob = get_cached_embedding(cursor, chunk['hash'])
+            if embedding_blob is not None:
+                cached_chunks.append(chunk)
+                cached_blobs.append(embedding_blob)
+            else:
+                to_embed.append(chunk)
 
-    # Проверка
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM code_style")
-    count = cursor.fetchone()[0]
-    conn.close()
+        insert_code_style_chunks(cursor, cached_chunks, cached_blobs)
+        conn.commit()
+        logger.info(f"Reused {len(cached_chunks)} embeddings from cache")
 
-    logger.info(f"✅ Verification: {count} embeddings in database")
+        # 7. Генерация недостающих embeddings батчами в пуле потоков и сохранение
+        logger.info(
+            f"Generating {len(to_embed)} embeddings (batch size {EMBED_BATCH_SIZE}, "
+            f"{EMBED_WORKERS} workers)..."
+        )
+        batches = [
+            to_embed[start:start + EMBED_BATCH_SIZE]
+            for start in range(0, len(to_embed), EMBED_BATCH_SIZE)
+        ]
+
+        # Потоки только ждут ответа Ollama; запись в SQLite - в главном потоке по порядку
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+            futures = [
+                executor.submit(generate_embeddings_batch, [chunk['text'] for chunk in batch])
+                for batch in batches
+            ]
+
+            start = 0
+            for batch, future in zip(batches, futures):
+                logger.debug(f"Processing chunks {start + 1}-{start + len(batch)}/{len(to_embed)}...")
+
+                try:
+                    embeddings = future.result()
+
+                    # Сохранить батч в БД и в кэш одной транзакцией
+                    embedding_blobs = [embedding_to_blob(embedding) for embedding in embeddings]
+                    store_cached_embeddings(cursor, [
+                        (chunk['hash'], embedding_blob)
+                        for chunk, embedding_blob in zip(batch, embedding_blobs)
+                    ])
+                    insert_code_style_chunks(cursor, batch, embedding_blobs)
+
+                    conn.commit()
+                except Exception as e:
+                    logger.error(f"Failed to process chunks {start + 1}-{start + len(batch)}: {e}")
+
+                start += len(batch)
+
+        logger.info(f"✅ Indexing complete! {len(chunks)} chunks indexed")
+        logger.info(f"Database: {DB_PATH}")
+
+        # Проверка
+        cursor.execute("SELECT COUNT(*) FROM code_style")
+        count = cursor.fetchone()[0]
+
+        logger.info(f"✅ Verification: {count} embeddings in database")
+    finally:
+        conn.close()
 
 
 def print_chunks_preview(chunks: list, num_to_show: int = 5):
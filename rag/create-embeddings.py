@@ -4,13 +4,35 @@
 Создание индекса Pond Mobile API Documentation с эмбеддингами через Ollama
 """
 
+import hashlib
 import json
-import sqlite3
+import os
 import pickle
+import re
+import sqlite3
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Tuple
+
+try:
+    import ijson
+except ImportError:  # опционально: без ijson dist.json загружается целиком
+    ijson = None
+
+try:
+    import tiktoken
+except ImportError:  # опционально: без tiktoken токенами считаются слова
+    tiktoken = None
+
+try:
+    import sqlite_vec
+except ImportError:  # опционально: без sqlite-vec поиск остается brute-force
+    sqlite_vec = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,23 +43,158 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация
 OLLAMA_API_URL = "http://127.0.0.1:11434/api/embeddings"
+OLLAMA_EMBED_URL = "http://127.0.0.1:11434/api/embed"  # batch endpoint
 OLLAMA_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))  # 128 для CUDA
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))  # параллельные запросы к Ollama
+EMBED_TIMEOUT = 60  # секунд на запрос с одним текстом
+EMBED_TIMEOUT_PER_TEXT = 5  # секунд сверх EMBED_TIMEOUT на каждый текст батча
+
+# Одна HTTP сессия на весь прогон: keep-alive вместо нового TCP соединения на запрос
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+# PRAGMA для записи индекса: WAL и меньше fsync на commit
+WRITE_PRAGMAS = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+"""
+
 CHUNK_SIZE = 512  # токенов
 CHUNK_OVERLAP = 50  # токенов
+TOKEN_ENCODING = "cl100k_base"  # BPE словарь tiktoken для подсчета токенов
+WORD_RE = re.compile(r'\S+')  # Слово для токенизации без tiktoken
 DB_PATH = Path(__file__).parent / "db.sqlite3"
+EMBEDDINGS_NPY_PATH = Path(__file__).parent / "embeddings.npy"  # матрица для mmap в retrieval.py
+EMBEDDINGS_IDS_PATH = Path(__file__).parent / "embeddings_ids.npy"  # id строк матрицы
 SOURCE_JSON = Path(__file__).parent.parent / "resources" / "dist.json"
 
+# Энкодер tiktoken (загружается один раз; None - токенизация по словам)
+_ENCODER = None
+_ENCODER_LOADED = False
+
+# Отформатированные свойства схем из components: ($ref, отступ) -> строки.
+# Общие схемы (ответы, ошибки) форматируются один раз на загрузку спецификации
+_SCHEMA_LINES_CACHE: Dict[Tuple[str, str], List[str]] = {}
+
 
 def load_api_spec() -> dict:
-    """Загрузить OpenAPI спецификацию из dist.json."""
+    """
+    Загрузить OpenAPI спецификацию из dist.json.
+
+    С ijson секция 'paths' не загружается: в памяти только info и
+    components (для $ref), endpoints читаются потоково в iter_api_paths.
+    Без ijson файл загружается целиком через json.load.
+
+    Returns:
+        Спецификация (с 'paths' только без ijson)
+    """
     logger.info(f"Loading API spec from {SOURCE_JSON}")
-    with open(SOURCE_JSON, 'r', encoding='utf-8') as f:
-        spec = json.load(f)
-    logger.info(f"Loaded OpenAPI spec version {spec['info']['version']}")
+    _SCHEMA_LINES_CACHE.clear()
+
+    if ijson is None:
+        with open(SOURCE_JSON, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+    else:
+        spec = {}
+        for section in ('info', 'components'):
+            with open(SOURCE_JSON, 'rb') as f:
+                spec[section] = next(ijson.items(f, section, use_float=True), {})
+
+    logger.info(f"Loaded OpenAPI spec version {deep_get(spec, 'info', 'version')}")
     return spec
 
 
-def format_endpoint_as_text(path: str, method: str, endpoint_data: dict) -> str:
+def iter_api_paths(spec: dict) -> Iterator[Tuple[str, dict]]:
+    """
+    Итерировать endpoints спецификации: (path, path_data).
+
+    Args:
+        spec: Спецификация из load_api_spec
+
+    Yields:
+        Путь и его методы; с ijson - потоково из dist.json, по одному пути
+    """
+    if 'paths' in spec:
+        yield from spec['paths'].items()
+        return
+
+    with open(SOURCE_JSON, 'rb') as f:
+        yield from ijson.kvitems(f, 'paths', use_float=True)
+
+
+def deep_get(data: Any, *keys: str, default: Any = None) -> Any:
+    """
+    Получить значение по цепочке ключей вложенных dict.
+
+    В отличие от цепочки .get(key, {}).get(...) не создает промежуточных
+    пустых dict и не падает, если промежуточное значение не dict.
+
+    Args:
+        data: Исходный dict
+        *keys: Цепочка ключей
+        default: Значение, если ключа нет
+
+    Returns:
+        Найденное значение или default
+    """
+    for key in keys:
+        if not isinstance(data, dict) or key not in data:
+            return default
+        data = data[key]
+    return data
+
+
+def resolve_ref(node: Any, spec: dict = None) -> Any:
+    """
+    Раскрыть локальную ссылку OpenAPI {"$ref": "#/components/..."}.
+
+    Args:
+        node: Узел спецификации (параметр, схема, response, ...)
+        spec: Полная спецификация (None - ссылки не раскрываются)
+
+    Returns:
+        Узел, на который указывает $ref, или исходный узел
+    """
+    ref = deep_get(node, '$ref')
+    if spec is None or not isinstance(ref, str) or not ref.startswith('#/'):
+        return node
+    return deep_get(spec, *ref[2:].split('/'), default={})
+
+
+def format_schema_properties(schema: Any, indent: str, spec: dict = None) -> List[str]:
+    """
+    Форматировать свойства схемы строками "- name (type): description".
+
+    Args:
+        schema: JSON Schema (может быть $ref)
+        indent: Отступ строк
+        spec: Полная спецификация для раскрытия $ref
+
+    Returns:
+        Строки свойств (пустой список, если у схемы нет properties)
+    """
+    # Inline схемы уникальны для endpoint, кэшируются только ссылки на components
+    ref = deep_get(schema, '$ref') if spec is not None else None
+    cache_key = (ref, indent)
+    if isinstance(ref, str) and cache_key in _SCHEMA_LINES_CACHE:
+        return _SCHEMA_LINES_CACHE[cache_key]
+
+    properties = deep_get(resolve_ref(schema, spec), 'properties') or {}
+    lines = [
+        f"{indent}- {prop_name} ({deep_get(prop_data, 'type', default='unknown')}): "
+        f"{deep_get(prop_data, 'description', default='')}"
+        for prop_name, prop_data in properties.items()
+    ]
+
+    if isinstance(ref, str):
+        _SCHEMA_LINES_CACHE[cache_key] = lines
+
+    return lines
+
+
+def format_endpoint_as_text(path: str, method: str, endpoint_data: dict, spec: dict = None) -> str:
     """
     Конвертировать endpoint в человеко-читаемый текстовый формат.
 
@@ -45,6 +202,8 @@ def format_endpoint_as_text(path: str, method: str, endpoint_data: dict) -> str:
         path: Путь endpoint (например, /core/countries)
         method: HTTP метод (GET, POST, etc.)
         endpoint_data: Данные endpoint из OpenAPI spec
+        spec: Полная спецификация для раскрытия $ref (параметры, схемы,
+            requestBody и responses из components)
 
     Returns:
         Форматированный текст описания endpoint
@@ -67,76 +226,97 @@ def format_endpoint_as_text(path: str, method: str, endpoint_data: dict) -> str:
         lines.append(f"Description: {endpoint_data['description']}")
 
     # Parameters
-    if 'parameters' in endpoint_data and endpoint_data['parameters']:
+    parameters = endpoint_data.get('parameters')
+    if parameters:
         lines.append("\nParameters:")
-        for param in endpoint_data['parameters']:
-            param_name = param.get('name', 'unknown')
-            param_in = param.get('in', 'unknown')
-            param_type = param.get('schema', {}).get('type', 'unknown')
-            param_desc = param.get('description', '')
+        for param in parameters:
+            param = resolve_ref(param, spec)
+            param_name = deep_get(param, 'name', default='unknown')
+            param_in = deep_get(param, 'in', default='unknown')
+            param_type = deep_get(resolve_ref(deep_get(param, 'schema'), spec), 'type', default='unknown')
+            param_desc = deep_get(param, 'description', default='')
 
             lines.append(f"- {param_name} ({param_in}, {param_type}): {param_desc}")
 
     # Request Body
     if 'requestBody' in endpoint_data:
         lines.append("\nRequest Body:")
-        req_body = endpoint_data['requestBody']
+        req_body = resolve_ref(endpoint_data['requestBody'], spec)
         if 'description' in req_body:
             lines.append(f"Description: {req_body['description']}")
 
-        if 'content' in req_body:
-            for content_type, content_data in req_body['content'].items():
-                lines.append(f"Content-Type: {content_type}")
-                if 'schema' in content_data:
-                    schema = content_data['schema']
-                    if 'properties' in schema:
-                        lines.append("Properties:")
-                        for prop_name, prop_data in schema['properties'].items():
-                            prop_type = prop_data.get('type', 'unknown')
-                            prop_desc = prop_data.get('description', '')
-                            lines.append(f"  - {prop_name} ({prop_type}): {prop_desc}")
+        for content_type, content_data in deep_get(req_body, 'content', default={}).items():
+            lines.append(f"Content-Type: {content_type}")
+            properties = format_schema_properties(deep_get(content_data, 'schema'), "  ", spec)
+            if properties:
+                lines.append("Properties:")
+                lines.extend(properties)
 
     # Responses
     if 'responses' in endpoint_data:
         lines.append("\nResponses:")
         for status_code, response_data in endpoint_data['responses'].items():
-            response_desc = response_data.get('description', '')
-            lines.append(f"- {status_code}: {response_desc}")
-
-            if 'content' in response_data:
-                for content_type, content_data in response_data['content'].items():
-                    if 'schema' in content_data:
-                        schema = content_data['schema']
-                        if 'properties' in schema:
-                            lines.append(f"  Returns ({content_type}):")
-                            for prop_name, prop_data in schema['properties'].items():
-                                prop_type = prop_data.get('type', 'unknown')
-                                prop_desc = prop_data.get('description', '')
-                                lines.append(f"    - {prop_name} ({prop_type}): {prop_desc}")
+            response_data = resolve_ref(response_data, spec)
+            lines.append(f"- {status_code}: {deep_get(response_data, 'description', default='')}")
+
+            for content_type, content_data in deep_get(response_data, 'content', default={}).items():
+                properties = format_schema_properties(deep_get(content_data, 'schema'), "    ", spec)
+                if properties:
+                    lines.append(f"  Returns ({content_type}):")
+                    lines.extend(properties)
 
     return '\n'.join(lines)
 
 
-def simple_tokenize(text: str) -> List[str]:
+def get_token_encoder():
     """
-    Простая токенизация по словам.
-    Для более точной токенизации нужно использовать tiktoken,
-    но для простоты используем разбиение по пробелам.
+    Получить энкодер tiktoken для подсчета токенов.
+
+    Энкодер создается один раз за процесс. При первом вызове tiktoken
+    скачивает BPE словарь, поэтому без сети (или без пакета tiktoken)
+    возвращается None и используется токенизация по словам.
+
+    Returns:
+        tiktoken.Encoding или None
+    """
+    global _ENCODER, _ENCODER_LOADED
+
+    if not _ENCODER_LOADED:
+        _ENCODER_LOADED = True
+        if tiktoken is not None:
+            try:
+                _ENCODER = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                logger.warning(f"tiktoken encoding {TOKEN_ENCODING} unavailable, using word split: {e}")
+
+    return _ENCODER
+
+
+def simple_tokenize(text: str) -> np.ndarray:
+    """
+    Простая токенизация по словам (fallback без tiktoken).
+
+    Слова не копируются: токен - пара смещений (start, end) в text,
+    так что окно токенов - это срез исходного текста.
 
     Args:
         text: Исходный текст
 
     Returns:
-        Список "токенов" (слов)
+        Массив формы (N, 2) со смещениями слов
     """
-    # Разбиваем по пробелам и знакам препинания
-    return text.split()
+    return np.array(
+        [match.span() for match in WORD_RE.finditer(text)], dtype=np.int64
+    ).reshape(-1, 2)
 
 
 def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
     """
     Разбить текст на чанки с перекрытием.
 
+    Размер считается в токенах tiktoken (TOKEN_ENCODING), если он доступен,
+    иначе в словах.
+
     Args:
         text: Исходный текст
         chunk_size: Размер чанка в токенах
@@ -145,44 +325,105 @@ def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVE
     Returns:
         Список текстовых чанков
     """
-    tokens = simple_tokenize(text)
-    chunks = []
+    encoder = get_token_encoder()
+    if encoder is not None:
+        # id токенов в массиве: срезы окон - views без копирования до decode
+        tokens = np.asarray(encoder.encode(text), dtype=np.int32)
 
-    i = 0
-    while i < len(tokens):
-        # Взять chunk_size токенов
-        chunk_tokens = tokens[i:i + chunk_size]
-        chunk_text = ' '.join(chunk_tokens)
-        chunks.append(chunk_text)
+        def detokenize(window: np.ndarray) -> str:
+            return encoder.decode(window.tolist())
+    else:
+        tokens = simple_tokenize(text)
 
-        # Сдвинуть на (chunk_size - overlap) вперёд
-        i += (chunk_size - overlap)
+        def detokenize(window: np.ndarray) -> str:
+            return text[window[0, 0]:window[-1, 1]]
 
-        # Если осталось слишком мало токенов для нового чанка - выходим
-        if i + overlap >= len(tokens):
-            break
+    if len(tokens) == 0:
+        return []
 
-    return chunks
+    # Окна сдвигаются на (chunk_size - overlap); окно, в котором остались
+    # бы только токены перекрытия предыдущего, не создается
+    starts = np.arange(0, max(len(tokens) - overlap, 1), chunk_size - overlap)
+
+    return [detokenize(tokens[start:start + chunk_size]) for start in starts]
+
+
+def generate_embeddings_batch(texts: List[str]) -> List[List[float]]:
+    """
+    Генерировать embeddings для нескольких текстов одним запросом к Ollama.
+
+    Использует batch endpoint /api/embed. Если он недоступен (старая
+    версия Ollama) или ответ без "embeddings", выполняет по одному
+    запросу на текст через /api/embeddings.
+
+    Args:
+        texts: Тексты для embedding
+
+    Returns:
+        Векторы embedding в порядке входных текстов
+    """
+    try:
+        try:
+            response = _SESSION.post(
+                OLLAMA_EMBED_URL,
+                json={
+                    'model': OLLAMA_MODEL,
+                    'input': texts
+                },
+                timeout=EMBED_TIMEOUT + EMBED_TIMEOUT_PER_TEXT * len(texts)
+            )
+        except requests.RequestException as e:
+            if len(texts) == 1:
+                raise
+            # Батч не уложился (таймаут, обрыв) - повторить по одному тексту,
+            # чтобы не потерять весь батч
+            logger.warning(f"Batch of {len(texts)} texts failed ({e}), retrying one by one")
+            return [generate_embedding_single(text) for text in texts]
+
+        if response.status_code != 404:
+            response.raise_for_status()
+            result = response.json()
+            if 'embeddings' in result:
+                return result['embeddings']
+
+        logger.warning("Ollama /api/embed unavailable, falling back to /api/embeddings")
+        return [generate_embedding_single(text) for text in texts]
+    except Exception as e:
+        logger.error(f"Error generating embeddings batch: {e}")
+        raise
 
 
 def generate_embedding(text: str) -> List[float]:
     """
-    Генерировать эмбеддинг через Ollama API.
+    Генерировать embedding для одного текста.
+
+    Args:
+        text: Текст для embedding
+
+    Returns:
+        Вектор embedding
+    """
+    return generate_embeddings_batch([text])[0]
+
+
+def generate_embedding_single(text: str) -> List[float]:
+    """
+    Генерировать embedding через legacy endpoint /api/embeddings.
 
     Args:
-        text: Текст для генерации эмбеддинга
+        text: Текст для embedding
 
     Returns:
-        Вектор эмбеддинга (список чисел)
+        Вектор embedding
     """
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_API_URL,
             json={
                 'model': OLLAMA_MODEL,
                 'prompt': text
             },
-            timeout=30
+            timeout=EMBED_TIMEOUT
         )
         response.raise_for_status()
         result = response.json()
@@ -201,6 +442,7 @@ def init_database() -> sqlite3.Connection:
     """
     logger.info(f"Initializing database at {DB_PATH}")
     conn = sqlite3.connect(DB_PATH)
+    conn.executescript(WRITE_PRAGMAS)
     cursor = conn.cursor()
 
     # Создать таблицу
@@ -208,7 +450,7 @@ def init_database() -> sqlite3.Connection:
     CREATE TABLE IF NOT EXISTS embeddings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         chunk_text TEXT NOT NULL,
-        embedding BLOB NOT NULL,
+        embedding BLOB NOT NULL,  -- dim x float32 (little-endian)
         endpoint_path TEXT,
         method TEXT,
         tag TEXT,
@@ -216,97 +458,526 @@ def init_database() -> sqlite3.Connection:
     )
     ''')
 
-    # Очистить таблицу если есть старые данные
-    cursor.execute('DELETE FROM embeddings')
+    # Миграция: content_hash для инкрементальной переиндексации
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(embeddings)')}
+    if 'content_hash' not in columns:
+        cursor.execute('ALTER TABLE embeddings ADD COLUMN content_hash TEXT')
+
+    # Миграция: модель embedding строки (после смены OLLAMA_MODEL строки
+    # пересчитываются). До появления колонки использовалась только OLLAMA_MODEL
+    if 'model' not in columns:
+        cursor.execute('ALTER TABLE embeddings ADD COLUMN model TEXT')
+        cursor.execute('UPDATE embeddings SET model = ?', (OLLAMA_MODEL,))
+
+    # Миграция: строки старого формата (pickle) -> float32 BLOB
+    migrate_legacy_embeddings(cursor)
+
+    # Размер BLOB embedding (dim x 4) как инвариант схемы
+    init_embeddings_meta(cursor)
+
+    # Кэш embeddings по SHA-256 текста (общий для всех индексаторов)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        hash TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        embedding BLOB NOT NULL  -- dim x float32 (little-endian)
+    )
+    ''')
 
     conn.commit()
     logger.info("Database initialized")
     return conn
 
 
-def process_api_spec(spec: dict, conn: sqlite3.Connection):
+def migrate_legacy_embeddings(cursor: sqlite3.Cursor) -> int:
     """
-    Обработать OpenAPI спецификацию и создать индекс.
+    Перезаписать embeddings старого формата (pickle списка float) в float32 BLOB.
+
+    Заодно заполняется content_hash, чтобы при переиндексации эти строки
+    считались неизмененными и не отправлялись в Ollama повторно.
+
+    Args:
+        cursor: Курсор БД
+
+    Returns:
+        Количество перезаписанных строк
+    """
+    # Кандидаты по заголовку pickle (PROTO ... STOP) отбираются в SQL
+    cursor.execute("""
+        SELECT id, chunk_text, embedding FROM embeddings
+        WHERE substr(embedding, 1, 1) = X'80' AND substr(embedding, -1, 1) = X'2E'
+    """)
+    updates = []
+    for row_id, text, embedding_blob in cursor.fetchall():
+        try:
+            embedding = pickle.loads(embedding_blob)
+        except Exception:
+            continue  # float32 BLOB, случайно совпавший по заголовку
+        if not isinstance(embedding, list):
+            continue
+        updates.append((embedding_to_blob(embedding), content_hash(text), row_id))
+
+    cursor.executemany(
+        'UPDATE embeddings SET embedding = ?, content_hash = COALESCE(content_hash, ?) WHERE id = ?',
+        updates
+    )
+    if updates:
+        logger.info(f"Migrated {len(updates)} legacy pickle embedding(s) to float32")
+    return len(updates)
+
+
+def init_embeddings_meta(cursor: sqlite3.Cursor):
+    """
+    Создать embeddings_meta и триггеры, фиксирующие размер BLOB embedding.
+
+    Размер записывается при первой вставке (или берется из уже
+    проиндексированных строк, если все они одного размера). Вставка BLOB
+    другого размера (например, после смены модели без пересоздания БД)
+    прерывается ошибкой SQLite. SQLite не допускает подзапросы в CHECK,
+    поэтому инвариант проверяется триггером.
+
+    Args:
+        cursor: Курсор БД
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS embeddings_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        byte_size INTEGER NOT NULL  -- length(embedding) = dim x 4
+    )
+    ''')
+
+    # Миграция: размер из существующих строк, если он у всех одинаковый
+    cursor.execute('''
+    INSERT OR IGNORE INTO embeddings_meta (id, byte_size)
+    SELECT 1, MIN(length(embedding)) FROM embeddings
+    HAVING COUNT(*) > 0 AND MIN(length(embedding)) = MAX(length(embedding))
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS embeddings_byte_size_check
+    BEFORE INSERT ON embeddings
+    WHEN length(NEW.embedding) != (SELECT byte_size FROM embeddings_meta WHERE id = 1)
+    BEGIN
+        SELECT RAISE(ABORT, 'embedding size differs from embeddings_meta.byte_size');
+    END
+    ''')
+
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS embeddings_byte_size_init
+    AFTER INSERT ON embeddings
+    BEGIN
+        INSERT OR IGNORE INTO embeddings_meta (id, byte_size)
+        VALUES (1, length(NEW.embedding));
+    END
+    ''')
+
+
+def reset_index_for_dimension(conn: sqlite3.Connection, dim: int) -> bool:
+    """
+    Очистить индекс, если размерность модели не совпадает с embeddings_meta.
+
+    После смены OLLAMA_MODEL на модель другой размерности старые строки
+    бесполезны, а триггер embeddings_byte_size_check отклонил бы все новые.
+    Строки и зафиксированный размер удаляются одной транзакцией, индекс
+    строится заново.
+
+    Args:
+        conn: Соединение с БД
+        dim: Размерность embeddings текущей модели (из пробного запроса)
+
+    Returns:
+        True, если индекс был очищен
+    """
+    row = conn.execute('SELECT byte_size FROM embeddings_meta WHERE id = 1').fetchone()
+    if row is None or row[0] == dim * 4:
+        return False
+
+    logger.warning(f"Embedding size changed: {row[0] // 4} -> {dim} "
+                   f"(model {OLLAMA_MODEL}), rebuilding index from scratch")
+    with conn:
+        conn.execute('DELETE FROM embeddings')
+        conn.execute('DELETE FROM embeddings_meta')
+    return True
+
+
+def content_hash(text: str) -> str:
+    """SHA-256 текста чанка (ключ кэша embeddings)."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_cached_embedding(cursor: sqlite3.Cursor, text_hash: str):
+    """
+    Найти сохраненный embedding по hash текста.
+
+    Args:
+        cursor: Курсор БД
+        text_hash: SHA-256 текста (content_hash)
+
+    Returns:
+        BLOB embedding или None, если в кэше нет записи для текущей модели
+    """
+    cursor.execute(
+        'SELECT embedding FROM embedding_cache WHERE hash = ? AND model = ?',
+        (text_hash, OLLAMA_MODEL)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def store_cached_embeddings(cursor: sqlite3.Cursor, entries: List[tuple]):
+    """
+    Сохранить embeddings в кэш по hash текста.
+
+    Args:
+        cursor: Курсор БД
+        entries: Список (content_hash, сериализованный embedding)
+    """
+    cursor.executemany(
+        'INSERT OR REPLACE INTO embedding_cache (hash, model, embedding) VALUES (?, ?, ?)',
+        [(text_hash, OLLAMA_MODEL, embedding_blob) for text_hash, embedding_blob in entries]
+    )
+
+
+def load_vec_extension(conn: sqlite3.Connection) -> bool:
+    """
+    Загрузить расширение sqlite-vec в соединение.
 
     Args:
-        spec: OpenAPI спецификация
         conn: Соединение с БД
+
+    Returns:
+        True если vec0 доступен, False если пакет sqlite-vec не установлен
+        или sqlite3 собран без поддержки расширений
     """
+    if sqlite_vec is None:
+        return False
+
+    try:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+        return True
+    except (AttributeError, sqlite3.Error) as e:
+        logger.warning(f"sqlite-vec extension is not available: {e}")
+        return False
+
+
+def rebuild_vec_index(conn: sqlite3.Connection) -> bool:
+    """
+    Пересобрать vec0-таблицу embeddings_vec из embeddings.
+
+    vec0-таблица хранит только векторы (rowid = embeddings.id), метаданные
+    остаются в embeddings. Размерность берется из сохраненных float32 BLOB,
+    поэтому смена модели не ломает индекс.
+
+    Args:
+        conn: Соединение с БД
+
+    Returns:
+        True если индекс пересобран, False если sqlite-vec недоступен
+        (поиск тогда выполняется brute-force по embeddings)
+    """
+    if not load_vec_extension(conn):
+        logger.info("sqlite-vec unavailable, skipping embeddings_vec (brute-force search)")
+        return False
+
     cursor = conn.cursor()
-    total_chunks = 0
-    total_endpoints = 0
+    cursor.execute('''
+        SELECT length(embedding) / 4 AS dim FROM embeddings
+        GROUP BY dim ORDER BY COUNT(*) DESC LIMIT 1
+    ''')
+    row = cursor.fetchone()
+
+    cursor.execute('''DROP TABLE IF EXISTS embeddings_vec''')
+    if row is None:
+        conn.commit()
+        return True
+
+    dim = row[0]
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE embeddings_vec USING vec0("
+        f"embedding float[{dim}] distance_metric=cosine)"
+    )
+    # Строки старого формата (pickle) имеют другую длину и в индекс не попадают
+    cursor.execute('''
+        INSERT INTO embeddings_vec (rowid, embedding)
+        SELECT id, embedding FROM embeddings WHERE length(embedding) = ?
+    ''', (dim * 4,))
+    conn.commit()
 
-    paths = spec.get('paths', {})
-    logger.info(f"Processing {len(paths)} endpoints...")
+    logger.info(f"✅ embeddings_vec rebuilt: {cursor.rowcount} vectors, dim {dim}")
+    return True
 
-    for path, path_data in paths.items():
-        for method, endpoint_data in path_data.items():
-            # Пропускаем не-методы (например, parameters)
-            if method not in ['get', 'post', 'put', 'delete', 'patch', 'options', 'head']:
-                continue
 
-            total_endpoints += 1
+def insert_embedding_rows(cursor: sqlite3.Cursor, rows: List[tuple], embedding_blobs: List[bytes]) -> int:
+    """
+    Сохранить чанки с embeddings в таблицу embeddings.
+
+    Вставка идет под SAVEPOINT: если триггер embeddings_byte_size_check
+    отклонит BLOB другого размера, откатывается только этот набор строк,
+    а индексация продолжается.
+
+    Args:
+        cursor: Курсор БД
+        rows: Список (chunk_text, endpoint_path, method, tag, original_json, content_hash)
+        embedding_blobs: Сериализованные embeddings в порядке rows
+
+    Returns:
+        Количество вставленных строк
+    """
+    if not rows:
+        return 0
+
+    # Внутри транзакции: RELEASE не коммитит, commit остается за вызывающим
+    if not cursor.connection.in_transaction:
+        cursor.execute('BEGIN')
+    cursor.execute('SAVEPOINT insert_embedding_rows')
+    try:
+        cursor.executemany('''
+        INSERT INTO embeddings (chunk_text, embedding, endpoint_path, method, tag, original_json, content_hash, model)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (current_chunk, embedding_blob, path, method, tag, original_json, text_hash, OLLAMA_MODEL)
+            for (current_chunk, path, method, tag, original_json, text_hash), embedding_blob
+            in zip(rows, embedding_blobs)
+        ])
+    except sqlite3.IntegrityError as e:
+        cursor.execute('ROLLBACK TO insert_embedding_rows')
+        cursor.execute('RELEASE insert_embedding_rows')
+        logger.error(f"  Failed to store {len(rows)} chunk(s): {e}")
+        return 0
+
+    cursor.execute('RELEASE insert_embedding_rows')
+    return len(rows)
+
+
+def embedding_to_blob(embedding) -> bytes:
+    """
+    Сериализовать embedding в BLOB: L2-нормализованный float32.
+
+    Векторы хранятся единичной длины, поэтому при поиске косинусное
+    сходство - это скалярное произведение без вычисления норм.
+
+    Args:
+        embedding: Вектор embedding (список float или массив)
+
+    Returns:
+        dim x float32 (little-endian)
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector = vector / norm
+    return vector.tobytes()
+
+
+def export_embeddings_matrix(conn: sqlite3.Connection) -> int:
+    """
+    Выгрузить embeddings в .npy для загрузки через mmap в retrieval.py.
+
+    Матрица (N, D) float32 и параллельный массив id пишутся во временные
+    файлы и атомарно заменяют старые: сначала матрица, затем id (retrieval.py
+    сверяет с БД массив id и строку матрицы последнего id).
+
+    Args:
+        conn: Соединение с БД
+
+    Returns:
+        Количество выгруженных векторов
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT length(embedding) / 4 AS dim FROM embeddings
+        GROUP BY dim ORDER BY COUNT(*) DESC LIMIT 1
+    ''')
+    row = cursor.fetchone()
+    dim = row[0] if row else 0
+
+    # Строки старого формата (pickle) имеют другую длину и в матрицу не попадают
+    ids, blobs = [], []
+    cursor.execute(
+        '''SELECT id, embedding FROM embeddings WHERE length(embedding) = ? ORDER BY id''',
+        (dim * 4,)
+    )
+    for row_id, embedding_blob in cursor:
+        ids.append(row_id)
+        blobs.append(embedding_blob)
 
-            # Извлечь метаданные
-            tags = endpoint_data.get('tags', [])
-            tag = tags[0] if tags else 'Uncategorized'
+    matrix = np.frombuffer(b''.join(blobs), dtype=np.float32).reshape(len(ids), dim)
 
-            # Форматировать endpoint в текст
-            endpoint_text = format_endpoint_as_text(path, method, endpoint_data)
+    try:
+        for path, array in (
+            (EMBEDDINGS_NPY_PATH, matrix),
+            (EMBEDDINGS_IDS_PATH, np.asarray(ids, dtype=np.int64)),
+        ):
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            tmp_path.replace(path)
+    except OSError as e:
+        logger.warning(f"Failed to export embeddings matrix: {e}")
+        return 0
+
+    logger.info(f"✅ Embeddings matrix exported: {EMBEDDINGS_NPY_PATH.name} {matrix.shape}")
+    return len(ids)
+
+
+def store_embeddings_batch(rows: List[tuple], embeddings_future: Future, conn: sqlite3.Connection) -> int:
+    """
+    Дождаться эмбеддингов батча чанков и сохранить их в БД и в кэш.
 
-            # Сохранить оригинальный JSON
-            original_json = json.dumps({
-                'path': path,
-                'method': method,
-                'data': endpoint_data
-            }, ensure_ascii=False)
+    Args:
+        rows: Список (chunk_text, endpoint_path, method, tag, original_json, content_hash)
+        embeddings_future: Future с результатом generate_embeddings_batch
+        conn: Соединение с БД
 
-            logger.info(f"Processing: {method.upper()} {path}")
+    Returns:
+        Количество сохраненных чанков
+    """
+    try:
+        embeddings = embeddings_future.result()
+    except Exception as e:
+        logger.error(f"  Failed to process batch of {len(rows)} chunk(s): {e}")
+        return 0
 
-            # Разбить на чанки
-            chunks = chunk_text(endpoint_text)
+    embedding_blobs = [embedding_to_blob(embedding) for embedding in embeddings]
 
-            if not chunks:
-                # Если текст короткий и не разбился на чанки
-                chunks = [endpoint_text]
+    cursor = conn.cursor()
+    store_cached_embeddings(cursor, [(row[-1], blob) for row, blob in zip(rows, embedding_blobs)])
+    stored = insert_embedding_rows(cursor, rows, embedding_blobs)
 
-            logger.info(f"  Created {len(chunks)} chunk(s)")
+    # Commit после каждого батча
+    conn.commit()
+    return stored
 
-            # Для каждого чанка: генерировать эмбеддинг и сохранить
-            for chunk_idx, current_chunk in enumerate(chunks):
-                logger.info(f"  Generating embedding for chunk {chunk_idx + 1}/{len(chunks)}...")
 
-                try:
-                    # Генерировать эмбеддинг
-                    embedding = generate_embedding(current_chunk)
-                    embedding_blob = pickle.dumps(embedding)
+def process_api_spec(spec: dict, conn: sqlite3.Connection):
+    """
+    Обработать OpenAPI спецификацию и создать индекс.
 
-                    # Сохранить в БД
-                    cursor.execute('''
-                    INSERT INTO embeddings (chunk_text, embedding, endpoint_path, method, tag, original_json)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    ''', (
-                        current_chunk,
-                        embedding_blob,
-                        path,
-                        method.upper(),
-                        tag,
-                        original_json
-                    ))
+    Args:
+        spec: OpenAPI спецификация из load_api_spec (endpoints читаются
+            через iter_api_paths)
+        conn: Соединение с БД
+    """
+    total_chunks = 0
+    total_endpoints = 0
+    unchanged_chunks = 0
+    cached_chunks = 0
+
+    # Уже проиндексированные строки: неизмененные чанки не пересчитываются
+    # и не перезаписываются, устаревшие удаляются в конце. Модель входит
+    # в ключ: строки с embedding другой модели считаются измененными
+    cursor = conn.cursor()
+    existing = {}
+    cursor.execute(
+        'SELECT id, model, chunk_text, endpoint_path, method, tag, original_json, content_hash FROM embeddings'
+    )
+    for row_id, *row in cursor.fetchall():
+        existing.setdefault(tuple(row), []).append(row_id)
 
-                    total_chunks += 1
+    # Чанки копятся между endpoints и отправляются в Ollama батчами.
+    # Батчи обрабатываются в пуле потоков, запись в SQLite - в этом потоке
+    # в порядке отправки (соединение sqlite3 не потокобезопасно).
+    pending = []
+    inflight = deque()
 
-                except Exception as e:
-                    logger.error(f"  Failed to process chunk {chunk_idx + 1}: {e}")
+    logger.info("Processing endpoints...")
+
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+
+        def submit(rows: List[tuple]):
+            logger.info(f"  Generating embeddings for {len(rows)} chunk(s)...")
+            future = executor.submit(generate_embeddings_batch, [row[0] for row in rows])
+            inflight.append((rows, future))
+
+        for path, path_data in iter_api_paths(spec):
+            for method, endpoint_data in path_data.items():
+                # Пропускаем не-методы (например, parameters)
+                if method not in ['get', 'post', 'put', 'delete', 'patch', 'options', 'head']:
                     continue
 
-            # Commit после каждого endpoint
-            conn.commit()
+                total_endpoints += 1
+
+                # Извлечь метаданные
+                tags = endpoint_data.get('tags', [])
+                tag = tags[0] if tags else 'Uncategorized'
+
+                # Форматировать endpoint в текст
+                endpoint_text = format_endpoint_as_text(path, method, endpoint_data, spec)
+
+                # Сохранить оригинальный JSON
+                original_json = json.dumps({
+                    'path': path,
+                    'method': method,
+                    'data': endpoint_data
+                }, ensure_ascii=False)
+
+                # Разбить на чанки
+                chunks = chunk_text(endpoint_text)
+
+                if not chunks:
+                    # Если текст короткий и не разбился на чанки
+                    chunks = [endpoint_text]
+
+                # Лог на каждый endpoint только в DEBUG
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Processing: {method.upper()} {path}: {len(chunks)} chunk(s)")
+
+                # Чанки с embedding в кэше пишутся одним executemany на endpoint
+                cached_rows, cached_blobs = [], []
+                for current_chunk in chunks:
+                    row = (current_chunk, path, method.upper(), tag, original_json,
+                           content_hash(current_chunk))
+
+                    row_ids = existing.get((OLLAMA_MODEL, *row))
+                    if row_ids:
+                        row_ids.pop()
+                        unchanged_chunks += 1
+                        continue
+
+                    embedding_blob = get_cached_embedding(cursor, row[-1])
+                    if embedding_blob is not None:
+                        cached_rows.append(row)
+                        cached_blobs.append(embedding_blob)
+                    else:
+                        pending.append(row)
+
+                stored = insert_embedding_rows(cursor, cached_rows, cached_blobs)
+                cached_chunks += stored
+                total_chunks += stored
+
+                if len(pending) >= EMBED_BATCH_SIZE:
+                    submit(pending)
+                    pending = []
+
+                # Ограничить число батчей в полете
+                while len(inflight) > EMBED_WORKERS:
+                    total_chunks += store_embeddings_batch(*inflight.popleft(), conn)
+
+        if pending:
+            submit(pending)
+
+        while inflight:
+            total_chunks += store_embeddings_batch(*inflight.popleft(), conn)
+
+    # Удалить строки endpoints, которых больше нет в спецификации
+    stale_ids = [(row_id,) for row_ids in existing.values() for row_id in row_ids]
+    cursor.executemany('DELETE FROM embeddings WHERE id = ?', stale_ids)
+    conn.commit()
+
+    # vec0-индекс для поиска средствами SQLite (если установлен sqlite-vec)
+    rebuild_vec_index(conn)
+
+    # Матрица для mmap-загрузки в retrieval.py
+    export_embeddings_matrix(conn)
 
     logger.info("=" * 60)
     logger.info(f"Processing complete!")
     logger.info(f"Total endpoints processed: {total_endpoints}")
     logger.info(f"Total chunks created: {total_chunks}")
+    logger.info(f"Unchanged chunks: {unchanged_chunks}, from cache: {cached_chunks}, "
+                f"removed: {len(stale_ids)}")
     logger.info(f"Database saved to: {DB_PATH}")
     logger.info("=" * 60)
 
@@ -321,6 +992,8 @@ def main():
     logger.info(f"Model: {OLLAMA_MODEL}")
     logger.info(f"Chunk size: {CHUNK_SIZE} tokens")
     logger.info(f"Chunk overlap: {CHUNK_OVERLAP} tokens")
+    logger.info(f"Tokenizer: {'tiktoken ' + TOKEN_ENCODING if get_token_encoder() else 'word split'}")
+    logger.info(f"Embedding batch size: {EMBED_BATCH_SIZE}, workers: {EMBED_WORKERS}")
     logger.info("=" * 60)
 
     # Проверить доступность Ollama
@@ -340,6 +1013,9 @@ def main():
     conn = init_database()
 
     try:
+        # Смена размерности модели: старые строки не совместимы с новыми
+        reset_index_for_dimension(conn, len(test_embedding))
+
         # Обработать спецификацию
         process_api_spec(spec, conn)
     finally:
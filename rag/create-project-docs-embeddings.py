@@ -10,9 +10,15 @@
 Сохраняет в отдельную таблицу project_docs в db.sqlite3
 """
 
+import hashlib
+import os
+import re
 import sqlite3
-import pickle
 import requests
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import logging
 
@@ -23,7 +29,28 @@ logger = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).parent.parent
 DB_PATH = Path(__file__).parent / "db.sqlite3"
 OLLAMA_API_URL = "http://127.0.0.1:11434/api/embeddings"
+OLLAMA_EMBED_URL = "http://127.0.0.1:11434/api/embed"  # batch endpoint
 OLLAMA_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))  # чанков в запросе к /api/embed, 128 для CUDA
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))  # параллельные запросы к Ollama
+
+# HTTP сессия для Ollama: keep-alive соединения и повтор при рестарте сервера
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
+
+# PRAGMA для записи индекса: WAL и меньше fsync на commit
+WRITE_PRAGMAS = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+"""
+
+# Заголовок markdown: строка, начинающаяся с '#'
+HEADING_RE = re.compile(r'^#[^\n]*', re.MULTILINE)
 
 # Документы для индексации
 DOCS_TO_INDEX = [
@@ -35,9 +62,45 @@ DOCS_TO_INDEX = [
 ]
 
 
+def generate_embeddings_batch(texts: list) -> list:
+    """
+    Генерировать embeddings для нескольких текстов одним запросом к Ollama.
+
+    Использует batch endpoint /api/embed. Если он недоступен (старая
+    версия Ollama) или ответ без "embeddings", выполняет по одному
+    запросу на текст через /api/embeddings.
+
+    Args:
+        texts: Тексты для embedding
+
+    Returns:
+        Векторы embedding в порядке входных текстов
+    """
+    try:
+        response = _SESSION.post(
+            OLLAMA_EMBED_URL,
+            json={
+                'model': OLLAMA_MODEL,
+                'input': texts
+            },
+            timeout=60
+        )
+        if response.status_code != 404:
+            response.raise_for_status()
+            result = response.json()
+            if 'embeddings' in result:
+                return result['embeddings']
+
+        logger.warning("Ollama /api/embed unavailable, falling back to /api/embeddings")
+        return [generate_embedding(text) for text in texts]
+    except Exception as e:
+        logger.error(f"Error generating embeddings batch: {e}")
+        raise
+
+
 def generate_embedding(text: str) -> list:
     """
-    Генерировать embedding через Ollama.
+    Генерировать embedding через legacy endpoint /api/embeddings.
 
     Args:
         text: Текст для embedding
@@ -46,7 +109,7 @@ def generate_embedding(text: str) -> list:
         Вектор embedding
     """
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_API_URL,
             json={
                 'model': OLLAMA_MODEL,
@@ -73,60 +136,41 @@ def chunk_markdown(content: str, chunk_size: int = 1000) -> list:
     Returns:
         Список чанков с метаданными
     """
-    chunks = []
-    lines = content.split('\n')
-
-    current_chunk = []
+    # Секции: (заголовок, уровень, начало, конец) - от строки заголовка
+    # до строки перед следующим заголовком; текст до первого - "Introduction"
+    sections = []
     current_heading = "Introduction"
     current_level = 0
+    current_start = 0
 
-    for line in lines:
-        # Обнаружение заголовка
-        if line.startswith('#'):
-            # Сохранить предыдущий чанк
-            if current_chunk:
-                chunk_text = '\n'.join(current_chunk)
-                if len(chunk_text) > chunk_size:
-                    # Разбить большой чанк на части
-                    sub_chunks = split_large_chunk(chunk_text, chunk_size)
-                    for i, sub in enumerate(sub_chunks):
-                        chunks.append({
-                            'text': sub,
-                            'heading': f"{current_heading} (часть {i+1})",
-                            'level': current_level
-                        })
-                else:
-                    chunks.append({
-                        'text': chunk_text,
-                        'heading': current_heading,
-                        'level': current_level
-                    })
-                current_chunk = []
-
-            # Новый заголовок
-            level = len(line.split()[0])  # Количество #
-            heading = line.lstrip('#').strip()
-            current_heading = heading
-            current_level = level
-
-        current_chunk.append(line)
-
-    # Последний чанк
-    if current_chunk:
-        chunk_text = '\n'.join(current_chunk)
-        if len(chunk_text) > chunk_size:
-            sub_chunks = split_large_chunk(chunk_text, chunk_size)
+    for match in HEADING_RE.finditer(content):
+        if match.start() > 0:
+            sections.append((current_heading, current_level, current_start, match.start() - 1))
+
+        line = match.group()
+        current_level = len(line.split()[0])  # Количество #
+        current_heading = line.lstrip('#').strip()
+        current_start = match.start()
+
+    sections.append((current_heading, current_level, current_start, len(content)))
+
+    chunks = []
+    for heading, level, start, end in sections:
+        # Размер секции известен по смещениям - срез строится только один раз
+        if end - start > chunk_size:
+            # Разбить большой чанк на части
+            sub_chunks = split_large_chunk(content[start:end], chunk_size)
             for i, sub in enumerate(sub_chunks):
                 chunks.append({
                     'text': sub,
-                    'heading': f"{current_heading} (часть {i+1})",
-                    'level': current_level
+                    'heading': f"{heading} (часть {i+1})",
+                    'level': level
                 })
         else:
             chunks.append({
-                'text': chunk_text,
-                'heading': current_heading,
-                'level': current_level
+                'text': content[start:end],
+                'heading': heading,
+                'level': level
             })
 
     return chunks
@@ -177,24 +221,75 @@ def create_database():
             heading TEXT NOT NULL,
             level INTEGER,
             chunk_text TEXT NOT NULL,
-            embedding BLOB NOT NULL,
+            embedding BLOB NOT NULL,  -- dim x float32 (little-endian)
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
 
+    # Миграция: content_hash для инкрементальной переиндексации
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(project_docs)")}
+    if 'content_hash' not in columns:
+        cursor.execute("ALTER TABLE project_docs ADD COLUMN content_hash TEXT")
+
+    # Миграция: модель embedding строки (после смены OLLAMA_MODEL строки
+    # пересчитываются). До появления колонки использовалась только OLLAMA_MODEL
+    if 'model' not in columns:
+        cursor.execute("ALTER TABLE project_docs ADD COLUMN model TEXT")
+        cursor.execute("UPDATE project_docs SET model = ?", (OLLAMA_MODEL,))
+
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_project_docs_hash
+        ON project_docs(doc_name, content_hash)
+    """)
+
     conn.commit()
     conn.close()
     logger.info("Database table 'project_docs' created/verified")
 
 
-def clear_existing_embeddings():
-    """Очистить существующие embeddings."""
+def remove_missing_documents(doc_names: list):
+    """
+    Удалить embeddings документов, которых больше нет в индексе.
+
+    Args:
+        doc_names: Имена документов, проиндексированных в этом запуске
+    """
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM project_docs")
+    cursor.execute(
+        f"DELETE FROM project_docs WHERE doc_name NOT IN ({','.join('?' * len(doc_names))})",
+        doc_names
+    )
+    removed = cursor.rowcount
     conn.commit()
     conn.close()
-    logger.info("Existing embeddings cleared")
+    if removed:
+        logger.info(f"Removed {removed} chunks of documents no longer indexed")
+
+
+def content_hash(text: str) -> str:
+    """SHA-256 текста чанка."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def embedding_to_blob(embedding) -> bytes:
+    """
+    Сериализовать embedding в BLOB: L2-нормализованный float32.
+
+    Векторы хранятся единичной длины, поэтому при поиске косинусное
+    сходство - это скалярное произведение без вычисления норм.
+
+    Args:
+        embedding: Вектор embedding (список float или массив)
+
+    Returns:
+        dim x float32 (little-endian)
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector = vector / norm
+    return vector.tobytes()
 
 
 def index_document(doc_path: Path):
@@ -218,38 +313,83 @@ def index_document(doc_path: Path):
     chunks = chunk_markdown(content)
     logger.info(f"Created {len(chunks)} chunks from {doc_path.name}")
 
-    # Создать embeddings и сохранить
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    for i, chunk in enumerate(chunks, 1):
-        try:
-            logger.info(f"  Processing chunk {i}/{len(chunks)}: {chunk['heading'][:50]}...")
+    # Лог на каждый батч только в DEBUG: иначе строки даже не форматируются
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-            # Генерировать embedding
-            embedding = generate_embedding(chunk['text'])
+    conn = sqlite3.connect(DB_PATH)
+    conn.executescript(WRITE_PRAGMAS)
+    try:
+        # Сравнить с уже проиндексированными строками документа по content hash
+        # и модели: неизмененные чанки не пересчитываются, удаляются только
+        # устаревшие (в том числе с embedding другой модели)
+        existing = {}
+        for row_id, heading, level, text_hash, model in conn.execute(
+            "SELECT id, heading, level, content_hash, model FROM project_docs WHERE doc_name = ?",
+            (doc_path.name,)
+        ):
+            existing.setdefault((heading, level, text_hash, model), []).append(row_id)
+
+        new_chunks = []
+        for chunk in chunks:
+            chunk['hash'] = content_hash(chunk['text'])
+            row_ids = existing.get((chunk['heading'], chunk['level'], chunk['hash'], OLLAMA_MODEL))
+            if row_ids:
+                row_ids.pop()
+            else:
+                new_chunks.append(chunk)
+
+        stale_ids = [(row_id,) for row_ids in existing.values() for row_id in row_ids]
+        logger.info(
+            f"Unchanged: {len(chunks) - len(new_chunks)}, "
+            f"new: {len(new_chunks)}, removed: {len(stale_ids)}"
+        )
 
-            # Сохранить в БД
-            cursor.execute("""
-                INSERT INTO project_docs (doc_name, heading, level, chunk_text, embedding)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                doc_path.name,
-                chunk['heading'],
-                chunk['level'],
-                chunk['text'],
-                pickle.dumps(embedding)
-            ))
+        # Создать embeddings: батчи параллельно в пуле потоков, результаты по порядку
+        batches = [
+            new_chunks[start:start + EMBED_BATCH_SIZE]
+            for start in range(0, len(new_chunks), EMBED_BATCH_SIZE)
+        ]
+
+        rows = []
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+            futures = [
+                executor.submit(generate_embeddings_batch, [chunk['text'] for chunk in batch])
+                for batch in batches
+            ]
+
+            start = 0
+            for batch, future in zip(batches, futures):
+                if debug:
+                    logger.debug(f"  Embedding chunks {start + 1}-{start + len(batch)}/{len(new_chunks)}")
+
+                try:
+                    embeddings = future.result()
+                except Exception as e:
+                    logger.error(
+                        f"  ✗ Failed to embed chunks {start + 1}-{start + len(batch)}: {e}"
+                    )
+                else:
+                    rows.extend(
+                        (doc_path.name, chunk['heading'], chunk['level'], chunk['text'],
+                         embedding_to_blob(embedding), chunk['hash'], OLLAMA_MODEL)
+                        for chunk, embedding in zip(batch, embeddings)
+                    )
 
-            conn.commit()
-            logger.info(f"  ✓ Chunk {i} saved")
+                start += len(batch)
 
-        except Exception as e:
-            logger.error(f"  ✗ Failed to process chunk {i}: {e}")
-            continue
+        # Сохранить изменения документа одной транзакцией
+        conn.executemany("DELETE FROM project_docs WHERE id = ?", stale_ids)
+        conn.executemany("""
+            INSERT INTO project_docs (doc_name, heading, level, chunk_text, embedding, content_hash, model)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    finally:
+        conn.close()
 
-    conn.close()
-    logger.info(f"✓ Completed {doc_path.name}")
+    logger.info(
+        f"✓ Completed {doc_path.name}: {len(chunks) - len(new_chunks) + len(rows)}/{len(chunks)} chunks"
+    )
 
 
 def main():
@@ -261,18 +401,19 @@ def main():
     # Создать БД
     create_database()
 
-    # Очистить старые embeddings
-    clear_existing_embeddings()
-
-    # Индексировать каждый документ
-    total_docs = 0
+    # Индексировать каждый документ (неизмененные чанки пропускаются)
+    indexed_names = []
     for doc_name in DOCS_TO_INDEX:
         doc_path = PROJECT_ROOT / doc_name
         if doc_path.exists():
             index_document(doc_path)
-            total_docs += 1
+            indexed_names.append(doc_path.name)
         else:
             logger.warning(f"Document not found: {doc_path}")
+    total_docs = len(indexed_names)
+
+    # Удалить embeddings документов, которых больше нет
+    remove_missing_documents(indexed_names)
 
     # Статистика
     conn = sqlite3.connect(DB_PATH)
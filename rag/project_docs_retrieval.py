@@ -5,10 +5,14 @@
 Поиск релевантных фрагментов из README, ARCHITECTURE, CODE_STYLE
 """
 
+import functools
 import sqlite3
+import threading
 import pickle
 import requests
 import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from typing import List, Dict, Tuple
 import logging
@@ -20,21 +24,57 @@ DB_PATH = Path(__file__).parent / "db.sqlite3"
 OLLAMA_API_URL = "http://127.0.0.1:11434/api/embeddings"
 OLLAMA_MODEL = "nomic-embed-text"
 TOP_K = 5
+QUERY_CACHE_SIZE = 1024  # Embeddings последних запросов в памяти процесса
 MIN_SIMILARITY = 0.4
 
+# HTTP сессия для Ollama: keep-alive соединения и повтор при рестарте сервера
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
+
+# PRAGMA для чтения индекса: большой page cache и mmap вместо read()
+READ_PRAGMAS = """
+    PRAGMA query_only = ON;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 268435456;
+"""
+
+# Соединение с БД на поток: page cache и подготовленные выражения живут между запросами
+_LOCAL = threading.local()
+
+# Первый байт pickle (opcode PROTO) - признак строк в старом формате
+PICKLE_MAGIC = b'\x80'
+
+# Кэш декодированных embeddings: (DB_PATH, mtime, состояние -wal) -> id и матрица
+_INDEX_CACHE: Dict[Tuple, Dict] = {}
+_INDEX_LOCK = threading.Lock()
 
-def generate_query_embedding(query: str) -> List[float]:
+
+def generate_query_embedding(query: str) -> np.ndarray:
     """
     Генерировать эмбеддинг для запроса пользователя.
 
+    Повторные запросы (с точностью до пробелов по краям) берутся из
+    LRU-кэша без обращения к Ollama.
+
     Args:
         query: Вопрос пользователя
 
     Returns:
-        Вектор эмбеддинга
+        Вектор эмбеддинга float32 (только для чтения, общий для повторов)
     """
+    return _embed_query(query.strip())
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_query(query: str) -> np.ndarray:
+    """Запросить embedding у Ollama (результат кэшируется по тексту запроса)."""
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_API_URL,
             json={
                 'model': OLLAMA_MODEL,
@@ -44,34 +84,136 @@ def generate_query_embedding(query: str) -> List[float]:
         )
         response.raise_for_status()
         result = response.json()
-        return result['embedding']
+        embedding = np.asarray(result['embedding'], dtype=np.float32)
+        embedding.setflags(write=False)
+        return embedding
     except Exception as e:
         logger.error(f"Error generating query embedding: {e}")
         raise
 
 
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+def decode_embedding(embedding_blob: bytes) -> np.ndarray:
     """
-    Вычислить косинусное сходство между двумя векторами.
+    Декодировать embedding из BLOB.
+
+    Формат хранения - L2-нормализованный dim x float32 (little-endian),
+    читается без копирования. Строки, проиндексированные до перехода на
+    float32 (pickle ненормализованного списка float), распознаются по
+    заголовку pickle и нормализуются при чтении.
 
     Args:
-        vec1: Первый вектор
-        vec2: Второй вектор
+        embedding_blob: BLOB из колонки embedding
+
+    Returns:
+        Вектор float32 единичной длины формы (D,)
+    """
+    if embedding_blob[:1] == PICKLE_MAGIC and embedding_blob[-1:] == b'.':
+        try:
+            vector = np.asarray(pickle.loads(embedding_blob), dtype=np.float32)
+        except Exception:
+            vector = None
+        if vector is not None:
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else vector
+
+    return np.frombuffer(embedding_blob, dtype=np.float32)
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Получить соединение с БД для текущего потока.
+
+    Соединение открывается один раз (только для чтения, с READ_PRAGMAS) и
+    переиспользуется: SQLite сохраняет page cache, а sqlite3 - кэш
+    подготовленных выражений между запросами.
+
+    Returns:
+        Соединение с БД
+    """
+    conn = getattr(_LOCAL, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True)
+        conn.executescript(READ_PRAGMAS)
+        _LOCAL.conn = conn
+    return conn
+
+
+def load_project_docs_index() -> Dict:
+    """
+    Загрузить embeddings project_docs в одну матрицу и параллельный массив id.
+
+    BLOB декодируются один раз; результат кэшируется до изменения БД
+    (или до вызова refresh_cache()).
 
     Returns:
-        Косинусное сходство (от -1 до 1)
+        Dict:
+            - ids: id строк project_docs, int64 формы (N,)
+            - embeddings: матрица float32 формы (N, D) нормализованных векторов
     """
-    v1 = np.array(vec1)
-    v2 = np.array(vec2)
+    cache_key = _index_version()
 
-    dot_product = np.dot(v1, v2)
-    norm1 = np.linalg.norm(v1)
-    norm2 = np.linalg.norm(v2)
+    with _INDEX_LOCK:
+        if cache_key is not None and cache_key in _INDEX_CACHE:
+            return _INDEX_CACHE[cache_key]
 
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+        ids = []
+        vectors = []
 
-    return float(dot_product / (norm1 * norm2))
+        cursor = get_connection().cursor()
+        cursor.execute("SELECT id, embedding FROM project_docs")
+
+        for id, embedding_blob in cursor:
+            try:
+                vector = decode_embedding(embedding_blob)
+                if vectors and vector.shape != vectors[0].shape:
+                    raise ValueError(f"dimension {vector.shape[0]} != {vectors[0].shape[0]}")
+                vectors.append(vector)
+            except Exception as e:
+                logger.warning(f"Failed to process chunk {id}: {e}")
+                continue
+
+            ids.append(id)
+
+        index = {
+            'ids': np.asarray(ids, dtype=np.int64),
+            'embeddings': (
+                np.stack(vectors) if vectors
+                else np.empty((0, 0), dtype=np.float32)
+            )
+        }
+
+        _INDEX_CACHE.clear()
+        _INDEX_CACHE[cache_key] = index
+
+    return index
+
+
+def _index_version():
+    """
+    Ключ версии индекса: (DB_PATH, mtime, состояние -wal) или None, если БД нет.
+
+    В режиме WAL commit дописывает файл -wal, а основной файл (mtime)
+    меняется только при checkpoint, поэтому учитываются mtime и размер -wal.
+    Ключ строится по файлам, а не по соединению, и одинаков во всех потоках.
+    """
+    try:
+        mtime = Path(DB_PATH).stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    try:
+        wal = Path(f"{DB_PATH}-wal").stat()
+        wal_version = (wal.st_mtime_ns, wal.st_size)
+    except FileNotFoundError:
+        wal_version = None
+
+    return (str(DB_PATH), mtime, wal_version)
+
+
+def refresh_cache():
+    """Сбросить кэш декодированных embeddings (следующий поиск перечитает БД)."""
+    with _INDEX_LOCK:
+        _INDEX_CACHE.clear()
 
 
 def search_project_docs(
@@ -99,52 +241,57 @@ def search_project_docs(
         logger.error(f"Failed to generate query embedding: {e}")
         return []
 
-    # 2. Загрузить все эмбеддинги из БД
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT id, doc_name, heading, level, chunk_text, embedding
-        FROM project_docs
-    """)
+    # 2. Косинусное сходство = скалярное произведение (чанки хранятся нормализованными)
+    norm = np.linalg.norm(query_embedding)
+    if norm:
+        query_embedding = query_embedding / norm
 
-    rows = cursor.fetchall()
-    conn.close()
+    # 3. Декодированные embeddings из кэша (БД читается только при изменении)
+    index = load_project_docs_index()
 
-    if not rows:
+    if not index['ids'].size:
         logger.warning("No project docs embeddings found in database")
         return []
 
-    logger.info(f"Loaded {len(rows)} embeddings from database")
+    logger.info(f"Loaded {index['ids'].size} embeddings from cache")
 
-    # 3. Вычислить косинусное сходство для каждого чанка
-    similarities = []
+    try:
+        scores = index['embeddings'] @ query_embedding
+    except ValueError as e:
+        logger.error(f"Query embedding does not match index dimension: {e}")
+        return []
 
-    for row in rows:
-        id, doc_name, heading, level, chunk_text, embedding_blob = row
+    candidates = np.flatnonzero(scores >= min_similarity)
+    similarities = [(float(scores[i]), int(index['ids'][i])) for i in candidates]
 
-        try:
-            chunk_embedding = pickle.loads(embedding_blob)
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-
-            if similarity >= min_similarity:
-                similarities.append({
-                    'id': id,
-                    'doc_name': doc_name,
-                    'heading': heading,
-                    'level': level,
-                    'chunk_text': chunk_text,
-                    'similarity': similarity
-                })
-        except Exception as e:
-            logger.warning(f"Failed to process chunk {id}: {e}")
-            continue
-
-    # 4. Сортировать по убыванию релевантности
-    similarities.sort(key=lambda x: x['similarity'], reverse=True)
-
-    # 5. Вернуть топ-K результатов
-    top_results = similarities[:top_k]
+    # 4. Сортировать по убыванию релевантности и взять топ-K
+    similarities.sort(key=lambda x: x[0], reverse=True)
+    similarities = similarities[:top_k]
+
+    # 5. Прочитать тексты и метаданные только для топ-K
+    cursor = get_connection().cursor()
+    cursor.execute(f"""
+        SELECT id, doc_name, heading, level, chunk_text
+        FROM project_docs
+        WHERE id IN ({','.join('?' * len(similarities))})
+    """, [id for _, id in similarities])
+
+    metadata = {
+        id: {
+            'id': id,
+            'doc_name': doc_name,
+            'heading': heading,
+            'level': level,
+            'chunk_text': chunk_text
+        }
+        for id, doc_name, heading, level, chunk_text in cursor
+    }
+
+    top_results = [
+        {**metadata[id], 'similarity': similarity}
+        for similarity, id in similarities
+        if id in metadata
+    ]
 
     logger.info(f"Found {len(top_results)} relevant chunks")
 
@@ -4,21 +4,49 @@
 Поиск релевантных чанков документации по запросу пользователя
 """
 
+import functools
+import os
 import sqlite3
+import time
 import pickle
 import requests
 import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from typing import List, Dict, Tuple
+from collections import deque
+import threading
 import logging
 
+try:
+    import sqlite_vec
+except ImportError:  # опционально: без него поиск brute-force по матрице
+    sqlite_vec = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # опционально: без него int8-scores через np.einsum
+    njit = None
+
 logger = logging.getLogger(__name__)
 
 # Конфигурация
 DB_PATH = Path(__file__).parent / "db.sqlite3"
+EMBEDDINGS_NPY_PATH = Path(__file__).parent / "embeddings.npy"  # выгрузка create-embeddings.py
+EMBEDDINGS_IDS_PATH = Path(__file__).parent / "embeddings_ids.npy"
 OLLAMA_API_URL = "http://127.0.0.1:11434/api/embeddings"
 OLLAMA_MODEL = "nomic-embed-text"
 TOP_K = 3  # Количество релевантных чанков для возврата
+QUERY_CACHE_SIZE = 1024  # Embeddings последних запросов в памяти процесса
+
+# HTTP сессия для Ollama: keep-alive соединения и повтор при рестарте сервера
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
 
 # День 18: Конфигурация фильтрации
 MIN_SIMILARITY_STRICT = 0.50  # Строгий минимальный порог (50%)
@@ -26,19 +54,65 @@ MIN_SIMILARITY_ORIGINAL = 0.3  # Исходный порог для сравне
 SCORE_GAP_THRESHOLD = 0.85  # Оставлять результаты в пределах 85% от топа
 FILTERING_MODE = "hybrid"  # Режимы: "none", "strict", "adaptive", "hybrid"
 
+# ANN-поиск через vec0-таблицу embeddings_vec (строит create-embeddings.py)
+VEC_CANDIDATES = 100  # Кандидатов из индекса для фильтрации и top-K
+
+# int8-матрица для brute-force поиска: в 4 раза меньше памяти, погрешность scores ~1e-3.
+# NumPy умножает int8 без BLAS, поэтому без numba это медленнее float32
+INT8_INDEX = os.getenv("RAG_INT8_INDEX", "0") == "1"
+
+# Семантический кэш ответов rag_query
+ANSWER_CACHE_SIZE = 256  # Последних ответов в памяти процесса
+ANSWER_CACHE_SIMILARITY = 0.95  # Минимальное сходство запросов для повторного использования
+ANSWER_CACHE_TTL = 600  # Время жизни записи, секунд
+
+# Первый байт pickle (opcode PROTO) - признак строк в старом формате
+PICKLE_MAGIC = b'\x80'
+
+# Кэш загруженного индекса: (DB_PATH, mtime, состояние -wal) -> матрица embeddings и метаданные
+_INDEX_CACHE: Dict[Tuple[str, int], Dict] = {}
+_INDEX_LOCK = threading.Lock()
+
+# PRAGMA для чтения индекса: большой page cache и mmap вместо read()
+READ_PRAGMAS = """
+    PRAGMA query_only = ON;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 268435456;
+"""
+
+# Соединение с БД на поток: page cache и подготовленные выражения живут между запросами
+_LOCAL = threading.local()
+
+# Расширение sqlite-vec не загрузилось (sqlite3 без поддержки расширений)
+_VEC_DISABLED = False
+
+# Кольцо последних ответов: dict(embedding, key, created_at, result)
+_ANSWER_CACHE = deque(maxlen=ANSWER_CACHE_SIZE)
+_ANSWER_LOCK = threading.Lock()
+
 
-def generate_query_embedding(query: str) -> List[float]:
+def generate_query_embedding(query: str) -> np.ndarray:
     """
     Генерировать эмбеддинг для запроса пользователя.
 
+    Повторные запросы (с точностью до пробелов по краям) берутся из
+    LRU-кэша без обращения к Ollama.
+
     Args:
         query: Вопрос пользователя
 
     Returns:
-        Вектор эмбеддинга
+        Вектор эмбеддинга float32 (только для чтения, общий для повторов)
     """
+    return _embed_query(query.strip())
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _embed_query(query: str) -> np.ndarray:
+    """Запросить embedding у Ollama (результат кэшируется по тексту запроса)."""
     try:
-        response = requests.post(
+        response = _SESSION.post(
             OLLAMA_API_URL,
             json={
                 'model': OLLAMA_MODEL,
@@ -48,36 +122,467 @@ def generate_query_embedding(query: str) -> List[float]:
         )
         response.raise_for_status()
         result = response.json()
-        return result['embedding']
+        embedding = np.asarray(result['embedding'], dtype=np.float32)
+        embedding.setflags(write=False)
+        return embedding
     except Exception as e:
         logger.error(f"Error generating query embedding: {e}")
         raise
 
 
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+def decode_embedding(embedding_blob: bytes) -> np.ndarray:
+    """
+    Декодировать embedding из BLOB.
+
+    Формат хранения - L2-нормализованный dim x float32 (little-endian),
+    читается без копирования. Строки, проиндексированные до перехода на
+    float32 (pickle ненормализованного списка float), распознаются по
+    заголовку pickle и нормализуются при чтении.
+
+    Args:
+        embedding_blob: BLOB из колонки embedding
+
+    Returns:
+        Вектор float32 единичной длины формы (D,)
+    """
+    if embedding_blob[:1] == PICKLE_MAGIC and embedding_blob[-1:] == b'.':
+        try:
+            vector = np.asarray(pickle.loads(embedding_blob), dtype=np.float32)
+        except Exception:
+            vector = None
+        if vector is not None:
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else vector
+
+    return np.frombuffer(embedding_blob, dtype=np.float32)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    L2-нормализовать строки матрицы (или одиночный вектор).
+
+    После нормализации косинусное сходство сводится к скалярному
+    произведению. Нулевые векторы остаются нулевыми.
+
+    Args:
+        matrix: Матрица формы (N, D) или вектор формы (D,)
+
+    Returns:
+        Нормализованный массив float32 той же формы
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms != 0)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _int8_dot_kernel(values, query):
+        """Скалярные произведения строк int8-матрицы с int32-вектором (numba, по ядрам CPU)."""
+        n, dim = values.shape
+        out = np.empty(n, dtype=np.int32)
+        for i in prange(n):
+            acc = 0
+            for j in range(dim):
+                acc += np.int32(values[i, j]) * query[j]
+            out[i] = acc
+        return out
+else:
+    _int8_dot_kernel = None
+
+
+def quantize_int8(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Симметрично квантовать строки матрицы в int8 с масштабом на строку.
+
+    Args:
+        matrix: Матрица формы (N, D) или вектор формы (D,)
+
+    Returns:
+        Tuple[values, scales]: int8 формы (N, D) и float32 масштабы формы (N,),
+        values * scales[:, None] приближает исходную матрицу
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    scales = np.abs(matrix).max(axis=1) / 127
+    safe_scales = np.where(scales > 0, scales, 1)
+
+    values = np.round(matrix / safe_scales[:, None]).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+
+def score_embeddings(index: Dict, query_embedding: np.ndarray) -> np.ndarray:
+    """
+    Косинусное сходство запроса со всеми чанками индекса.
+
+    Args:
+        index: Результат load_embeddings_index()
+        query_embedding: Embedding запроса
+
+    Returns:
+        Массив float32 формы (N,)
+
+    Raises:
+        ValueError: Если размерность запроса не совпадает с индексом
+    """
+    query = normalize_rows(query_embedding)
+
+    if 'scales' not in index:
+        return index['embeddings'] @ query
+
+    # int8: накопление в int32, затем обратное масштабирование
+    query_values, query_scale = quantize_int8(query)
+    query_values = query_values[0].astype(np.int32)
+
+    if query_values.shape[0] != index['embeddings'].shape[1]:
+        raise ValueError(
+            f"query dimension {query_values.shape[0]} != index dimension "
+            f"{index['embeddings'].shape[1]}"
+        )
+
+    if _int8_dot_kernel is not None:
+        dots = _int8_dot_kernel(index['embeddings'], query_values)
+    else:
+        dots = np.einsum('ij,j->i', index['embeddings'], query_values, dtype=np.int32)
+
+    return dots.astype(np.float32) * index['scales'] * query_scale[0]
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Получить соединение с БД embeddings для текущего потока.
+
+    Соединение открывается один раз (только для чтения, с READ_PRAGMAS) и
+    переиспользуется: SQLite сохраняет page cache, а sqlite3 - кэш
+    подготовленных выражений между запросами.
+
+    Returns:
+        Соединение с БД
+    """
+    conn = getattr(_LOCAL, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(f"{Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True)
+        conn.executescript(READ_PRAGMAS)
+        _LOCAL.conn = conn
+    return conn
+
+
+def load_embeddings_index() -> Dict:
+    """
+    Загрузить embeddings в одну матрицу и параллельный массив id.
+
+    Embeddings хранятся L2-нормализованными и декодируются один раз;
+    результат кэшируется до изменения файла БД. Тексты чанков и
+    original_json в кэш не читаются - они подгружаются только для
+    результатов поиска (fetch_chunk_metadata).
+
+    Returns:
+        Dict:
+            - ids: id строк embeddings, int64 формы (N,)
+            - embeddings: L2-нормализованная матрица float32 формы (N, D)
+              (int8 при RAG_INT8_INDEX=1)
+            - scales: масштабы строк int8-матрицы (только при RAG_INT8_INDEX=1)
+    """
+    cache_key = _index_version()
+
+    with _INDEX_LOCK:
+        if cache_key is not None and cache_key in _INDEX_CACHE:
+            return _INDEX_CACHE[cache_key]
+
+        index = _read_embeddings_index()
+
+        _INDEX_CACHE.clear()
+        _INDEX_CACHE[cache_key] = index
+
+    return index
+
+
+def refresh_cache():
+    """
+    Сбросить кэши индекса и ответов (следующий поиск перечитает БД).
+
+    Изменения БД обнаруживаются и без этого; вызов нужен, если индекс
+    перестроен и результат требуется немедленно, без проверки версии.
+    """
+    with _INDEX_LOCK:
+        _INDEX_CACHE.clear()
+    with _ANSWER_LOCK:
+        _ANSWER_CACHE.clear()
+
+
+def _index_version():
+    """
+    Ключ версии индекса: (DB_PATH, mtime, состояние -wal) или None, если БД нет.
+
+    В режиме WAL commit дописывает файл -wal, а основной файл (mtime)
+    меняется только при checkpoint, поэтому учитываются mtime и размер -wal.
+    Ключ строится по файлам, а не по соединению, и одинаков во всех потоках.
+    """
+    try:
+        mtime = Path(DB_PATH).stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    try:
+        wal = Path(f"{DB_PATH}-wal").stat()
+        wal_version = (wal.st_mtime_ns, wal.st_size)
+    except FileNotFoundError:
+        wal_version = None
+
+    return (str(DB_PATH), mtime, wal_version)
+
+
+def _read_embeddings_index() -> Dict:
+    """
+    Прочитать id и embeddings (без кэша).
+
+    Если выгрузка .npy соответствует БД, матрица открывается через mmap без
+    чтения embeddings; иначе читается из таблицы. Выгрузку пишет только
+    create-embeddings.py после индексации.
+    """
+    index = _load_npy_index()
+    if index is not None:
+        return index
+
+    ids = []
+    vectors = []
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, embedding FROM embeddings")
+
+    for id, embedding_blob in cursor:
+        try:
+            vector = decode_embedding(embedding_blob)
+            if vectors and vector.shape != vectors[0].shape:
+                raise ValueError(f"dimension {vector.shape[0]} != {vectors[0].shape[0]}")
+            vectors.append(vector)
+        except Exception as e:
+            logger.warning(f"Failed to process chunk {id}: {e}")
+            continue
+
+        ids.append(id)
+
+    ids = np.asarray(ids, dtype=np.int64)
+
+    if not vectors:
+        return {'ids': ids, 'embeddings': np.empty((0, 0), dtype=np.float32)}
+
+    return _make_index(ids, np.stack(vectors))
+
+
+def _make_index(ids: np.ndarray, matrix: np.ndarray) -> Dict:
+    """Собрать индекс из id и матрицы (int8-квантование при RAG_INT8_INDEX=1)."""
+    if INT8_INDEX:
+        values, scales = quantize_int8(matrix)
+        return {'ids': ids, 'embeddings': values, 'scales': scales}
+
+    return {'ids': ids, 'embeddings': matrix}
+
+
+def _load_npy_index() -> Dict:
+    """
+    Открыть выгрузку embeddings.npy через mmap, если она соответствует БД.
+
+    Строки embeddings только добавляются и удаляются (id AUTOINCREMENT не
+    переиспользуются), поэтому совпадение COUNT(*) и MAX(id) с массивом id
+    выгрузки означает тот же набор строк. Сравнение по mtime не подходит:
+    в тот же файл БД пишут и другие индексаторы.
+
+    Returns:
+        Индекс как у load_embeddings_index() или None, если выгрузки нет,
+        она устарела или повреждена
+    """
+    if not (EMBEDDINGS_NPY_PATH.exists() and EMBEDDINGS_IDS_PATH.exists()):
+        return None
+
+    try:
+        ids = np.load(EMBEDDINGS_IDS_PATH)
+        matrix = np.load(EMBEDDINGS_NPY_PATH, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to load {EMBEDDINGS_NPY_PATH.name}: {e}")
+        return None
+
+    if matrix.ndim != 2 or matrix.shape[0] != ids.shape[0] or matrix.dtype != np.float32:
+        return None
+
+    conn = get_connection()
+    count, max_id = conn.execute("SELECT COUNT(*), MAX(id) FROM embeddings").fetchone()
+    if count != ids.shape[0] or (count and max_id != int(ids.max())):
+        return None
+
+    # Файлы заменяются по одному: матрица из другой выгрузки (того же
+    # размера) отличается от БД в строке последнего id
+    if count:
+        row = conn.execute("SELECT embedding FROM embeddings WHERE id = ?", (int(ids[-1]),)).fetchone()
+        if row is None or row[0] != matrix[-1].tobytes():
+            return None
+
+    logger.info(f"Embeddings matrix mapped from {EMBEDDINGS_NPY_PATH.name}: {matrix.shape}")
+    return _make_index(ids, matrix)
+
+
+def fetch_chunk_metadata(chunks: List[Dict]) -> List[Dict]:
     """
-    Вычислить косинусное сходство между двумя векторами.
+    Дополнить найденные чанки текстом и метаданными из таблицы embeddings.
+
+    Читаются только строки результатов, а не вся таблица.
 
     Args:
-        vec1: Первый вектор
-        vec2: Второй вектор
+        chunks: Чанки с ключами id и similarity
 
     Returns:
-        Косинусное сходство (от -1 до 1)
+        Чанки в том же порядке с полями chunk_text, endpoint_path, method,
+        tag, original_json (строки, удаленные переиндексацией, пропускаются)
+    """
+    if not chunks:
+        return []
+
+    ids = [chunk['id'] for chunk in chunks]
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT id, chunk_text, endpoint_path, method, tag, original_json
+        FROM embeddings
+        WHERE id IN ({','.join('?' * len(ids))})
+    """, ids)
+
+    metadata = {
+        id: {
+            'id': id,
+            'chunk_text': chunk_text,
+            'endpoint_path': endpoint_path,
+            'method': method,
+            'tag': tag,
+            'original_json': original_json
+        }
+        for id, chunk_text, endpoint_path, method, tag, original_json in cursor
+    }
+
+    return [
+        {**metadata[chunk['id']], 'similarity': chunk['similarity']}
+        for chunk in chunks
+        if chunk['id'] in metadata
+    ]
+
+
+def load_vec_extension(conn: sqlite3.Connection) -> bool:
+    """
+    Загрузить расширение sqlite-vec в соединение.
+
+    Args:
+        conn: Соединение с БД
+
+    Returns:
+        True если vec0 доступен, False если пакет sqlite-vec не установлен
+        или sqlite3 собран без поддержки расширений
+    """
+    global _VEC_DISABLED
+
+    if sqlite_vec is None or _VEC_DISABLED:
+        return False
+
+    # Соединения переиспользуются: расширение загружается в каждое один раз
+    if getattr(_LOCAL, 'vec_conn', None) is conn:
+        return True
+
+    try:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+        _LOCAL.vec_conn = conn
+        return True
+    except (AttributeError, sqlite3.Error) as e:
+        logger.warning(f"sqlite-vec extension is not available, using brute-force search: {e}")
+        _VEC_DISABLED = True
+        return False
+
+
+def search_vec_index(query_embedding: np.ndarray, min_similarity: float) -> List[Dict]:
     """
-    # Конвертировать в numpy arrays
-    v1 = np.array(vec1)
-    v2 = np.array(vec2)
+    Найти ближайшие чанки через vec0-индекс embeddings_vec (sqlite-vec).
 
-    # Косинусное сходство = dot product / (norm1 * norm2)
-    dot_product = np.dot(v1, v2)
-    norm1 = np.linalg.norm(v1)
-    norm2 = np.linalg.norm(v2)
+    Индекс возвращает VEC_CANDIDATES ближайших векторов по косинусному
+    расстоянию (только id и similarity).
 
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+    Args:
+        query_embedding: Embedding запроса
+        min_similarity: Минимальное косинусное сходство
 
-    return float(dot_product / (norm1 * norm2))
+    Returns:
+        Чанки {id, similarity} по убыванию similarity или None, если индекс недоступен
+        (тогда используется brute-force поиск)
+    """
+    if sqlite_vec is None or _VEC_DISABLED:
+        return None
+
+    conn = get_connection()
+    try:
+        if not load_vec_extension(conn):
+            return None
+
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'embeddings_vec'")
+        if cursor.fetchone() is None:
+            return None
+
+        cursor.execute("""
+            SELECT rowid, 1.0 - distance AS similarity
+            FROM embeddings_vec
+            WHERE embedding MATCH ? AND k = ?
+            ORDER BY distance
+        """, (normalize_rows(query_embedding).tobytes(), VEC_CANDIDATES))
+
+        return [
+            {'id': id, 'similarity': similarity}
+            for id, similarity in cursor
+            if similarity >= min_similarity
+        ]
+    except sqlite3.Error as e:
+        logger.warning(f"embeddings_vec search failed, using brute-force search: {e}")
+        return None
+
+
+def _filter_strict(
+    chunks: List[Dict], min_similarity: float, adaptive_cutoff: float
+) -> Tuple[List[Dict], int, int]:
+    """Оставить чанки не ниже строгого порога."""
+    kept = [chunk for chunk in chunks if chunk['similarity'] >= min_similarity]
+    return kept, len(chunks) - len(kept), 0
+
+
+def _filter_adaptive(
+    chunks: List[Dict], min_similarity: float, adaptive_cutoff: float
+) -> Tuple[List[Dict], int, int]:
+    """Оставить чанки не ниже адаптивного порога."""
+    kept = [chunk for chunk in chunks if chunk['similarity'] >= adaptive_cutoff]
+    return kept, 0, len(chunks) - len(kept)
+
+
+def _filter_hybrid(
+    chunks: List[Dict], min_similarity: float, adaptive_cutoff: float
+) -> Tuple[List[Dict], int, int]:
+    """Применить строгий порог, затем адаптивный (статистика по каждому этапу)."""
+    passed_strict = [chunk for chunk in chunks if chunk['similarity'] >= min_similarity]
+    kept = [chunk for chunk in passed_strict if chunk['similarity'] >= adaptive_cutoff]
+    return kept, len(chunks) - len(passed_strict), len(passed_strict) - len(kept)
+
+
+def _filter_passthrough(
+    chunks: List[Dict], min_similarity: float, adaptive_cutoff: float
+) -> Tuple[List[Dict], int, int]:
+    """Неизвестный режим: ничего не отсекать."""
+    return list(chunks), 0, 0
+
+
+# Специализированные фильтры по режиму: (chunks, min_similarity, adaptive_cutoff)
+# -> (отфильтрованные чанки, отсечено строгим порогом, отсечено адаптивным)
+_FILTERS = {
+    "strict": _filter_strict,
+    "adaptive": _filter_adaptive,
+    "hybrid": _filter_hybrid,
+}
 
 
 def filter_chunks_by_relevance(
@@ -132,23 +637,11 @@ def filter_chunks_by_relevance(
     adaptive_cutoff = chunks[0]['similarity'] * score_gap_threshold
     stats["adaptive_cutoff"] = adaptive_cutoff
 
-    filtered = []
-
-    for chunk in chunks:
-        score = chunk['similarity']
-
-        # Применить фильтры в зависимости от режима
-        if mode in ["strict", "hybrid"]:
-            if score < min_similarity:
-                stats["filtered_strict"] += 1
-                continue
-
-        if mode in ["adaptive", "hybrid"]:
-            if score < adaptive_cutoff:
-                stats["filtered_adaptive"] += 1
-                continue
-
-        filtered.append(chunk)
+    # Фильтр выбирается один раз, без проверки режима на каждом чанке
+    filter_fn = _FILTERS.get(mode, _filter_passthrough)
+    filtered, stats["filtered_strict"], stats["filtered_adaptive"] = filter_fn(
+        chunks, min_similarity, adaptive_cutoff
+    )
 
     stats["output_count"] = len(filtered)
     return filtered, stats
@@ -183,56 +676,38 @@ def search_relevant_chunks(
         query_embedding = generate_query_embedding(query)
     except Exception as e:
         logger.error(f"Failed to generate query embedding: {e}")
-        return []
-
-    # 2. Загрузить все эмбеддинги из БД
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT id, chunk_text, embedding, endpoint_path, method, tag, original_json
-        FROM embeddings
-    """)
-
-    rows = cursor.fetchall()
-    conn.close()
+        return [], {}
 
-    if not rows:
-        logger.warning("No embeddings found in database")
-        return []
+    # 2. Кандидаты из vec0-индекса, если установлен sqlite-vec
+    similarities = search_vec_index(query_embedding, min_similarity)
 
-    logger.info(f"Loaded {len(rows)} embeddings from database")
+    if similarities is not None:
+        logger.info(f"Found {len(similarities)} candidates in embeddings_vec")
+    else:
+        # 3. Brute-force: все эмбеддинги (матрица кэшируется между запросами)
+        index = load_embeddings_index()
 
-    # 3. Вычислить косинусное сходство для каждого чанка
-    similarities = []
+        if not index['ids'].size:
+            logger.warning("No embeddings found in database")
+            return [], {}
 
-    for row in rows:
-        id, chunk_text, embedding_blob, endpoint_path, method, tag, original_json = row
+        logger.info(f"Loaded {index['ids'].size} embeddings from database")
 
+        # Косинусное сходство = скалярное произведение нормализованных векторов
         try:
-            # Распаковать эмбеддинг
-            chunk_embedding = pickle.loads(embedding_blob)
-
-            # Вычислить сходство
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-
-            # Сохранить только если выше минимального порога
-            if similarity >= min_similarity:
-                similarities.append({
-                    'id': id,
-                    'chunk_text': chunk_text,
-                    'endpoint_path': endpoint_path,
-                    'method': method,
-                    'tag': tag,
-                    'original_json': original_json,
-                    'similarity': similarity
-                })
-        except Exception as e:
-            logger.warning(f"Failed to process chunk {id}: {e}")
-            continue
+            scores = score_embeddings(index, query_embedding)
+        except ValueError as e:
+            logger.error(f"Query embedding does not match index dimension: {e}")
+            return [], {}
+
+        candidates = np.flatnonzero(scores >= min_similarity)
 
-    # 4. Сортировать по убыванию релевантности
-    similarities.sort(key=lambda x: x['similarity'], reverse=True)
+        # 4. Сортировать по убыванию релевантности (dict только для прошедших порог)
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        similarities = [
+            {'id': int(index['ids'][i]), 'similarity': float(scores[i])}
+            for i in candidates
+        ]
 
     # 5. Применить фильтрацию второго этапа, если включена
     filter_stats = {}
@@ -262,8 +737,8 @@ def search_relevant_chunks(
             "adaptive_cutoff": None
         }
 
-    # 6. Вернуть топ-K результатов ПОСЛЕ фильтрации
-    top_results = similarities[:top_k]
+    # 6. Вернуть топ-K результатов ПОСЛЕ фильтрации (тексты читаются только для них)
+    top_results = fetch_chunk_metadata(similarities[:top_k])
 
     logger.info(f"Returning {len(top_results)} chunks")
 
@@ -304,24 +779,95 @@ def format_context_for_llm(chunks: List[Dict]) -> str:
     return "\n".join(context_parts)
 
 
+def lookup_cached_answer(query_embedding: np.ndarray, key: Tuple) -> Tuple:
+    """
+    Найти в кэше ответ на семантически близкий запрос.
+
+    Args:
+        query_embedding: Нормализованный embedding запроса
+        key: Параметры поиска и версия индекса, которые должны совпасть
+
+    Returns:
+        Закэшированный (context, chunks, filter_stats) или None
+    """
+    now = time.monotonic()
+
+    with _ANSWER_LOCK:
+        entries = [
+            entry for entry in _ANSWER_CACHE
+            if entry['key'] == key and now - entry['created_at'] < ANSWER_CACHE_TTL
+        ]
+        if not entries:
+            return None
+
+        # Все записи сравниваются одним умножением матрицы на вектор
+        scores = np.stack([entry['embedding'] for entry in entries]) @ query_embedding
+        best = int(np.argmax(scores))
+
+    if scores[best] < ANSWER_CACHE_SIMILARITY:
+        return None
+
+    logger.info(f"Answer cache hit (similarity: {scores[best]:.3f})")
+    return entries[best]['result']
+
+
+def store_cached_answer(query_embedding: np.ndarray, key: Tuple, result: Tuple):
+    """
+    Сохранить ответ rag_query в семантический кэш.
+
+    Args:
+        query_embedding: Нормализованный embedding запроса
+        key: Параметры поиска и версия индекса
+        result: (context, chunks, filter_stats)
+    """
+    with _ANSWER_LOCK:
+        _ANSWER_CACHE.append({
+            'embedding': query_embedding,
+            'key': key,
+            'created_at': time.monotonic(),
+            'result': result
+        })
+
+
 def rag_query(
     question: str,
     top_k: int = TOP_K,
     enable_filtering: bool = True,
-    filtering_mode: str = None
+    filtering_mode: str = None,
+    no_cache: bool = False
 ) -> Tuple[str, List[Dict], Dict]:
     """
     Выполнить RAG-запрос: найти релевантные чанки и сформировать контекст.
 
+    Ответы кэшируются: для запроса, близкого к недавнему (косинусное
+    сходство >= ANSWER_CACHE_SIMILARITY при тех же параметрах и той же
+    версии БД), возвращается сохраненный результат без поиска.
+
     Args:
         question: Вопрос пользователя
         top_k: Количество релевантных чанков
         enable_filtering: Применить фильтрацию второго этапа
         filtering_mode: Переопределить режим фильтрации по умолчанию
+        no_cache: Не использовать семантический кэш ответов
 
     Returns:
         Tuple[context, chunks, filter_stats] - контекст для LLM, список чанков и статистика фильтрации
     """
+    # Проверить семантический кэш (embedding запроса переиспользуется поиском)
+    cache_embedding = None
+    cache_key = (top_k, enable_filtering, filtering_mode, _index_version())
+
+    if not no_cache:
+        try:
+            cache_embedding = normalize_rows(generate_query_embedding(question))
+        except Exception:
+            cache_embedding = None
+
+        if cache_embedding is not None:
+            cached = lookup_cached_answer(cache_embedding, cache_key)
+            if cached is not None:
+                return cached
+
     # Поиск релевантных чанков с фильтрацией
     relevant_chunks, filter_stats = search_relevant_chunks(
         question,
@@ -337,6 +883,9 @@ def rag_query(
     # Форматирование контекста
     context = format_context_for_llm(relevant_chunks)
 
+    if cache_embedding is not None:
+        store_cached_answer(cache_embedding, cache_key, (context, relevant_chunks, filter_stats))
+
     return context, relevant_chunks, filter_stats
 
 
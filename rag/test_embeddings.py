@@ -4,114 +4,298 @@
 """
 
 import sqlite3
+import sys
 import pickle
+import numpy as np
 from pathlib import Path
 
+try:
+    from numba import njit, prange
+except ImportError:  # опционально: без него проверка через np.isfinite
+    njit = None
+
 DB_PATH = Path(__file__).parent / "db.sqlite3"
 
+# Скрипт только читает БД: большой page cache и mmap вместо копирования страниц
+READ_PRAGMAS = """
+    PRAGMA query_only = ON;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 268435456;
+"""
+
+
+def load_embedding(embedding_blob: bytes) -> np.ndarray:
+    """Распаковать embedding: float32 BLOB или pickle (строки старого формата)."""
+    if embedding_blob[:1] == b'\x80' and embedding_blob[-1:] == b'.':
+        try:
+            legacy = pickle.loads(embedding_blob)
+        except Exception:
+            legacy = None
+        if legacy is not None:
+            return np.asarray(legacy, dtype=np.float32)
+    # Без копирования и без упаковки каждого числа в Python float
+    return np.frombuffer(embedding_blob, dtype=np.float32)
+
+
+def is_valid_embedding(embedding: np.ndarray) -> bool:
+    """Проверить что embedding - одномерный вектор из конечных чисел."""
+    return embedding.ndim == 1 and bool(np.isfinite(embedding).all())
+
+
+# Без fastmath: он считает NaN/inf невозможными и ломает саму проверку
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _finite_rows_kernel(matrix):
+        """Флаг конечности для каждой строки матрицы (numba, по ядрам CPU)."""
+        n, dim = matrix.shape
+        out = np.ones(n, dtype=np.bool_)
+        for i in prange(n):
+            for j in range(dim):
+                if not np.isfinite(matrix[i, j]):
+                    out[i] = False
+                    break
+        return out
+else:
+    _finite_rows_kernel = None
+
+
+def finite_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Проверить какие строки матрицы состоят только из конечных чисел.
+
+    С numba строки проверяются параллельно и без временной bool-матрицы
+    (с выходом на первом NaN/inf), иначе - np.isfinite по всей матрице.
+
+    Args:
+        matrix: Матрица embeddings (N, D) float32
+
+    Returns:
+        Массив bool длины N
+    """
+    if _finite_rows_kernel is not None:
+        return _finite_rows_kernel(matrix)
+    return np.isfinite(matrix).all(axis=1)
+
+
+def report_invalid_rows(conn: sqlite3.Connection, errors: dict):
+    """
+    Напечатать некорректные записи с их id.
+
+    Проверка читает только колонку embedding (в порядке id), поэтому id
+    запрашиваются отдельно и только если некорректные записи есть.
+
+    Args:
+        conn: Соединение с БД
+        errors: Словарь {позиция строки в порядке id: описание ошибки}
+    """
+    if not errors:
+        return
+    ids = conn.execute("SELECT id FROM embeddings ORDER BY id")
+    lines = [
+        f"✗ ID {id}: {errors[position]}"
+        for position, (id,) in enumerate(ids) if position in errors
+    ]
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
+def validate_embeddings_matrix(conn: sqlite3.Connection, count: int) -> tuple:
+    """
+    Проверить embeddings одинакового размера одним проходом NumPy.
+
+    Векторы копируются в заранее выделенную матрицу (count, D), после чего
+    конечность всех значений проверяется одной операцией по всей матрице.
+
+    Args:
+        conn: Соединение с БД
+        count: Количество записей (из агрегатного запроса)
+
+    Returns:
+        Кортеж (корректных, некорректных, множество размерностей)
+    """
+    decoded = np.zeros(count, dtype=bool)
+    matrix = None
+    errors = {}
+
+    # BLOB копируется один раз: из bytes курсора (frombuffer - без копии)
+    # сразу в строку матрицы. conn.blobopen() здесь не быстрее: у sqlite3.Blob
+    # нет readinto, а открытие blob на каждую строку ~3x медленнее выборки
+    rows = conn.execute("SELECT embedding FROM embeddings ORDER BY id LIMIT ?", (count,))
+    for i, (embedding_blob,) in enumerate(rows):
+        try:
+            embedding = load_embedding(embedding_blob)
+            if matrix is None:
+                matrix = np.empty((count, embedding.size), dtype=np.float32)
+            if embedding.shape != matrix.shape[1:]:
+                raise ValueError(f"shape {embedding.shape}, expected {matrix.shape[1:]}")
+            matrix[i] = embedding
+            decoded[i] = True
+        except Exception as e:
+            errors[i] = f"failed to decode: {e}"
+
+    valid_count = 0
+    if matrix is not None:
+        valid = decoded & finite_rows(matrix)
+        for i in np.flatnonzero(decoded & ~valid):
+            errors[int(i)] = "invalid embedding type or content"
+        valid_count = int(valid.sum())
+
+    report_invalid_rows(conn, errors)
+    return valid_count, len(errors), {matrix.shape[1]} if valid_count else set()
+
+
+def validate_embeddings_per_row(conn: sqlite3.Connection) -> tuple:
+    """
+    Проверить embeddings по одному (BLOB разного размера).
+
+    Args:
+        conn: Соединение с БД
+
+    Returns:
+        Кортеж (корректных, некорректных, множество размерностей)
+    """
+    valid_count = 0
+    errors = {}
+    dimensions = set()
+    last_dim = -1
+
+    # Строки читаются из курсора по одной, без fetchall() всех BLOB в память
+    rows = conn.execute("SELECT embedding FROM embeddings ORDER BY id")
+    for i, (embedding_blob,) in enumerate(rows):
+        try:
+            embedding = load_embedding(embedding_blob)
+            if is_valid_embedding(embedding):
+                valid_count += 1
+                # В множество - только при смене размерности, а не на каждой строке
+                if embedding.size != last_dim:
+                    last_dim = embedding.size
+                    dimensions.add(last_dim)
+            else:
+                errors[i] = "invalid embedding type or content"
+        except Exception as e:
+            errors[i] = f"failed to decode: {e}"
+
+    report_invalid_rows(conn, errors)
+    return valid_count, len(errors), dimensions
+
+
 def test_embeddings():
     """Проверить что эмбеддинги корректно сохранены."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # Только чтение: mode=ro без записи в БД, autocommit без BEGIN/COMMIT
+    conn = sqlite3.connect(
+        f"{DB_PATH.resolve().as_uri()}?mode=ro",
+        uri=True,
+        isolation_level=None,
+        cached_statements=256
+    )
+    conn.executescript(READ_PRAGMAS)
 
-    # Получить общую статистику
-    cursor.execute("SELECT COUNT(*) FROM embeddings")
-    total_count = cursor.fetchone()[0]
+    # Получить общую статистику: количество, размеры BLOB и распределение
+    # по тегам считаются в SQL за один проход по таблице
+    tag_stats = conn.execute("""
+        SELECT tag, COUNT(*) as count,
+               MIN(length(embedding)), MAX(length(embedding))
+        FROM embeddings
+        GROUP BY tag
+        ORDER BY count DESC
+    """).fetchall()
+    total_count = sum(row[1] for row in tag_stats)
+    min_blob_size = min((row[2] for row in tag_stats), default=None)
+    max_blob_size = max((row[3] for row in tag_stats), default=None)
     print(f"Всего записей в БД: {total_count}")
 
+    # Размер BLOB, зафиксированный индексатором (create-embeddings.py)
+    try:
+        meta_row = conn.execute("SELECT byte_size FROM embeddings_meta WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        meta_row = None  # БД проиндексирована до появления embeddings_meta
+    schema_blob_size = meta_row[0] if meta_row else None
+
     # Получить первую запись
-    cursor.execute("""
+    row = conn.execute("""
         SELECT id, endpoint_path, method, tag, embedding,
                substr(chunk_text, 1, 100) as preview
         FROM embeddings
         LIMIT 1
-    """)
-
-    row = cursor.fetchone()
+    """).fetchone()
     if row:
         id, path, method, tag, embedding_blob, preview = row
 
-        print("\n" + "=" * 60)
-        print("Пример записи:")
-        print("=" * 60)
-        print(f"ID: {id}")
-        print(f"Endpoint: {method} {path}")
-        print(f"Tag: {tag}")
-        print(f"Preview: {preview}...")
-        print(f"\nEmbedding BLOB size: {len(embedding_blob)} bytes")
+        # Блок выводится одной записью в stdout
+        lines = [
+            "\n" + "=" * 60,
+            "Пример записи:",
+            "=" * 60,
+            f"ID: {id}",
+            f"Endpoint: {method} {path}",
+            f"Tag: {tag}",
+            f"Preview: {preview}...",
+            f"\nEmbedding BLOB size: {len(embedding_blob)} bytes",
+        ]
 
         # Распаковать эмбеддинг
         try:
-            embedding = pickle.loads(embedding_blob)
-            print(f"✓ Embedding успешно распакован")
-            print(f"✓ Тип: {type(embedding)}")
-            print(f"✓ Размерность: {len(embedding)}")
-            print(f"✓ Первые 5 значений: {embedding[:5]}")
-            print(f"✓ Последние 5 значений: {embedding[-5:]}")
-
-            # Проверить что все элементы - числа
-            if all(isinstance(x, (int, float)) for x in embedding):
-                print(f"✓ Все элементы - числа")
+            embedding = load_embedding(embedding_blob)
+            lines.append(f"✓ Embedding успешно распакован")
+            lines.append(f"✓ Тип: {type(embedding)} ({embedding.dtype})")
+            lines.append(f"✓ Размерность: {len(embedding)}")
+            lines.append(f"✓ Первые 5 значений: {embedding[:5].tolist()}")
+            lines.append(f"✓ Последние 5 значений: {embedding[-5:].tolist()}")
+
+            # Проверить что все элементы - конечные числа
+            if is_valid_embedding(embedding):
+                lines.append(f"✓ Все элементы - конечные числа")
             else:
-                print(f"✗ Не все элементы - числа!")
+                lines.append(f"✗ Не все элементы - конечные числа!")
 
         except Exception as e:
-            print(f"✗ Ошибка при распаковке embedding: {e}")
+            lines.append(f"✗ Ошибка при распаковке embedding: {e}")
+
+        sys.stdout.write("\n".join(lines) + "\n")
 
     # Проверить все записи
     print("\n" + "=" * 60)
     print("Проверка всех записей:")
     print("=" * 60)
 
-    cursor.execute("SELECT id, embedding FROM embeddings")
-    rows = cursor.fetchall()
+    if schema_blob_size is not None:
+        if total_count and not min_blob_size == max_blob_size == schema_blob_size:
+            print(f"✗ Размер BLOB от {min_blob_size} до {max_blob_size} bytes, "
+                  f"в embeddings_meta: {schema_blob_size} bytes")
+        else:
+            print(f"✓ Размер BLOB по embeddings_meta: {schema_blob_size} bytes "
+                  f"({schema_blob_size // 4} x float32)")
 
-    valid_count = 0
-    invalid_count = 0
-    dimensions = set()
+    if total_count and min_blob_size == max_blob_size:
+        # Все BLOB одного размера - проверка одним векторным проходом по матрице
+        print(f"✓ Все BLOB одного размера: {min_blob_size} bytes")
+        valid_count, invalid_count, dimensions = validate_embeddings_matrix(conn, total_count)
+    else:
+        valid_count, invalid_count, dimensions = validate_embeddings_per_row(conn)
 
-    for row in rows:
-        id, embedding_blob = row
-        try:
-            embedding = pickle.loads(embedding_blob)
-            if isinstance(embedding, list) and all(isinstance(x, (int, float)) for x in embedding):
-                valid_count += 1
-                dimensions.add(len(embedding))
-            else:
-                invalid_count += 1
-                print(f"✗ ID {id}: invalid embedding type or content")
-        except Exception as e:
-            invalid_count += 1
-            print(f"✗ ID {id}: failed to unpickle: {e}")
+    conn.close()
 
-    print(f"\n✓ Корректных эмбеддингов: {valid_count}")
-    print(f"✗ Некорректных эмбеддингов: {invalid_count}")
-    print(f"📊 Уникальные размерности: {dimensions}")
+    # Итоги выводятся одной записью в stdout
+    lines = [
+        f"\n✓ Корректных эмбеддингов: {valid_count}",
+        f"✗ Некорректных эмбеддингов: {invalid_count}",
+        f"📊 Уникальные размерности: {dimensions}",
+    ]
 
     if len(dimensions) == 1:
-        print(f"✓ Все эмбеддинги имеют одинаковую размерность: {list(dimensions)[0]}")
+        lines.append(f"✓ Все эмбеддинги имеют одинаковую размерность: {list(dimensions)[0]}")
 
     # Показать распределение по тегам
-    print("\n" + "=" * 60)
-    print("Распределение по категориям (tags):")
-    print("=" * 60)
+    lines.append("\n" + "=" * 60)
+    lines.append("Распределение по категориям (tags):")
+    lines.append("=" * 60)
 
-    cursor.execute("""
-        SELECT tag, COUNT(*) as count
-        FROM embeddings
-        GROUP BY tag
-        ORDER BY count DESC
-    """)
-
-    for row in cursor.fetchall():
-        tag, count = row
-        print(f"  {tag}: {count} чанков")
+    lines.extend(f"  {tag}: {count} чанков" for tag, count, _, _ in tag_stats)
 
-    conn.close()
-
-    print("\n" + "=" * 60)
-    print("Проверка завершена!")
-    print("=" * 60)
+    lines.append("\n" + "=" * 60)
+    lines.append("Проверка завершена!")
+    lines.append("=" * 60)
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":